@@ -1,19 +1,35 @@
 import base64
+import io
 import json
 import math
 import os
 import re
-import zipfile
-from typing import Tuple
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Tuple
 from urllib.error import HTTPError, URLError
 from urllib.parse import quote
-from urllib.request import Request, urlopen
 
 import platform_maps
+from bandwidth import Priority
+from cache import ImageCache
+from catalog import CatalogCache, CatalogEntry
+from downloads import DownloadResult, DownloadScheduler, QueueOrder, order_queue
+from extract import (
+    CorruptArchive,
+    StreamingUnsupported,
+    StreamingZipExtractor,
+    ZipExtractor,
+)
 from filesystem import Filesystem
+from journal import DownloadJournal
 from models import Collection, Platform, Rom
 from PIL import Image
+from session import Response, Session, TransferStalled
 from status import Status, View
+from transfer import SegmentedDownload, StreamCopier, preallocate, split_segments
+from verify import IntegrityError, RomVerifier
+from watchdog import TransferWatchdog
 
 
 class API:
@@ -28,6 +44,7 @@ class API:
     def __init__(self):
         self.status = Status()
         self.file_system = Filesystem()
+        self.image_cache = ImageCache()
 
         self.host = os.getenv("HOST", "")
         self.username = os.getenv("USERNAME", "")
@@ -37,12 +54,52 @@ class API:
         self._include_collections = set(self._getenv_list("INCLUDE_COLLECTIONS"))
         self._exclude_collections = set(self._getenv_list("EXCLUDE_COLLECTIONS"))
         self._collection_type = os.getenv("COLLECTION_TYPE", "collection")
+        self._preallocate_downloads = (
+            os.getenv("PREALLOCATE_DOWNLOADS", "false").lower() == "true"
+        )
+        # Multi-file ROM zips are extracted as they are downloaded
+        self._stream_extract = os.getenv("STREAM_EXTRACT", "true").lower() == "true"
+        # Large single-file ROMs are fetched over several connections
+        self._download_segments = int(os.getenv("DOWNLOAD_SEGMENTS", "4"))
+        self._segmented_download_bytes = (
+            int(os.getenv("SEGMENTED_DOWNLOAD_MB", "512")) * 1024**2
+        )
+        # Downloads not matching the server hash are fetched again this many times
+        self._verify_retries = int(os.getenv("VERIFY_RETRIES", "1"))
+        self._queue_order = os.getenv("QUEUE_ORDER", QueueOrder.NAME).lower()
+        # Stalled downloads are resumed this many times before giving up
+        self._stall_retries = int(os.getenv("STALL_RETRIES", "3"))
+        # SD card each ROM of the current batch is downloaded to, by ROM id
+        self._placement: dict[int, int] = {}
 
         if self.username and self.password:
             credentials = f"{self.username}:{self.password}"
             auth_token = base64.b64encode(credentials.encode("utf-8")).decode("utf-8")
             self.headers = {"Authorization": f"Basic {auth_token}"}
 
+        # Keep-alive connections shared by every request to the host
+        self.session = Session(headers=self.headers)
+        self.watchdog = TransferWatchdog(self.status)
+        # Queue of the current batch, kept next to resources/ to resume it
+        self.journal = DownloadJournal(
+            os.path.join(
+                os.path.dirname(self.file_system.resources_path), "download_queue.jsonl"
+            )
+        )
+        # Last catalog lists seen, shown while the server is asked for changes
+        self.catalog = CatalogCache(
+            os.path.join(os.path.dirname(self.file_system.resources_path), "catalog"),
+            self.username,
+        )
+
+        # Missing platform icons are fetched in the background
+        self._icon_executor = ThreadPoolExecutor(
+            max_workers=int(os.getenv("ICON_FETCH_WORKERS", "4")),
+            thread_name_prefix="icon",
+        )
+        self._icons_pending: set[str] = set()
+        self._icons_lock = threading.Lock()
+
     @staticmethod
     def _getenv_list(key: str) -> list[str]:
         value = os.getenv(key)
@@ -58,46 +115,78 @@ class API:
         s = round(size_bytes / p, 2)
         return (s, size_name[i])
 
-    def _sanitize_filename(self, filename: str) -> str:
-        path_parts = os.path.normpath(filename).split(os.sep)
-        sanitized_parts = []
-
-        for _i, part in enumerate(path_parts):
-            sanitized = re.sub(r'[\\/*?:"<>|\t\n\r\b]', "_", part)
-            sanitized_parts.append(sanitized)
-
-        return os.path.join(*sanitized_parts)
-
-    def _fetch_user_profile_picture(self, avatar_path: str) -> None:
-        fs_extension = avatar_path.split(".")[-1]
+    def _request(
+        self,
+        url: str,
+        timeout: Optional[float] = 60,
+        missing_ok: bool = False,
+        headers: Optional[dict[str, str]] = None,
+    ) -> Optional[Response]:
+        """
+        GET url through the shared session, updating the host and credentials
+        status if it fails. Returns None on failure.
+        """
         try:
-            request = Request(
-                f"{self.host}/{self._user_profile_picture_url}/{avatar_path}",
-                headers=self.headers,
-            )
+            return self.session.get(url, headers=headers, timeout=timeout)
         except ValueError as e:
             print(e)
             self.status.valid_host = False
             self.status.valid_credentials = False
-            return
-        try:
-            if request.type not in ("http", "https"):
-                self.status.valid_host = False
-                self.status.valid_credentials = False
-                return
-            response = urlopen(request, timeout=60)  # trunk-ignore(bandit/B310)
         except HTTPError as e:
             print(e)
             if e.code == 403:
                 self.status.valid_host = True
                 self.status.valid_credentials = False
-                return
+            # Resource is missing on the server
+            elif e.code == 404 and missing_ok:
+                self.status.valid_host = True
+                self.status.valid_credentials = True
+                print(f"Requested resource not found: {url}")
             else:
                 raise
         except URLError as e:
             print(e)
             self.status.valid_host = False
             self.status.valid_credentials = False
+        return None
+
+    def _revalidate_catalog(
+        self, url: str, cached: Optional[CatalogEntry], timeout: Optional[float] = 60
+    ) -> Tuple[Optional[CatalogEntry], bool]:
+        """
+        GET the catalog JSON at url, conditionally if there's a cached copy.
+        Returns the latest entry, None on failure, and whether it differs
+        from the cached copy.
+        """
+        response = self._request(
+            url, timeout=timeout, headers=CatalogCache.validators(cached)
+        )
+        if response is None:
+            return None, False
+        body = response.read()
+        if response.status == 304 and cached is not None:
+            print(f"Catalog unchanged: {url}")
+            return cached, False
+        entry = self.catalog.put(url, body, response)
+        # Servers without validators send the same body again
+        return entry, cached is None or entry.digest != cached.digest
+
+    def _sanitize_filename(self, filename: str) -> str:
+        path_parts = os.path.normpath(filename).split(os.sep)
+        sanitized_parts = []
+
+        for _i, part in enumerate(path_parts):
+            sanitized = re.sub(r'[\\/*?:"<>|\t\n\r\b]', "_", part)
+            sanitized_parts.append(sanitized)
+
+        return os.path.join(*sanitized_parts)
+
+    def _fetch_user_profile_picture(self, avatar_path: str) -> None:
+        fs_extension = avatar_path.split(".")[-1]
+        response = self._request(
+            f"{self.host}/{self._user_profile_picture_url}/{avatar_path}"
+        )
+        if response is None:
             return
         if not os.path.exists(self.file_system.resources_path):
             os.makedirs(self.file_system.resources_path)
@@ -109,37 +198,13 @@ class API:
         icon = Image.open(self.status.profile_pic_path)
         icon = icon.resize((26, 26))
         icon.save(self.status.profile_pic_path)
+        self.image_cache.invalidate(self.status.profile_pic_path)
         self.status.valid_host = True
         self.status.valid_credentials = True
 
     def fetch_me(self) -> None:
-        try:
-            request = Request(
-                f"{self.host}/{self._user_me_endpoint}", headers=self.headers
-            )
-        except ValueError as e:
-            print(e)
-            self.status.valid_host = False
-            self.status.valid_credentials = False
-            return
-        try:
-            if request.type not in ("http", "https"):
-                self.status.valid_host = False
-                self.status.valid_credentials = False
-                return
-            response = urlopen(request, timeout=60)  # trunk-ignore(bandit/B310)
-        except HTTPError as e:
-            print(e)
-            if e.code == 403:
-                self.status.valid_host = True
-                self.status.valid_credentials = False
-                return
-            else:
-                raise
-        except URLError as e:
-            print(e)
-            self.status.valid_host = False
-            self.status.valid_credentials = False
+        response = self._request(f"{self.host}/{self._user_me_endpoint}")
+        if response is None:
             return
         me = json.loads(response.read().decode("utf-8"))
         self.status.me = me
@@ -148,94 +213,69 @@ class API:
         self.status.me_ready.set()
 
     def _fetch_platform_icon(self, platform_slug) -> None:
-        try:
-            mapped_slug, icon_filename = platform_maps.ES_FOLDER_MAP.get(
-                platform_slug.lower(), (platform_slug, platform_slug)
-            )
-            icon_url = f"{self.host}/{self._platform_icon_url}/{icon_filename}.ico"
-            request = Request(
-                f"{self.host}/{self._platform_icon_url}/{icon_filename}.ico",
-                headers=self.headers,
-            )
-        except ValueError as e:
-            print(e)
-            self.status.valid_host = False
-            self.status.valid_credentials = False
-            return
-
-        try:
-            if request.type not in ("http", "https"):
-                self.status.valid_host = False
-                self.status.valid_credentials = False
-                return
-            response = urlopen(request, timeout=60)  # trunk-ignore(bandit/B310)
-        except HTTPError as e:
-            print(e)
-            if e.code == 403:
-                self.status.valid_host = True
-                self.status.valid_credentials = False
-                return
-            # Icon is missing on the server
-            elif e.code == 404:
-                self.status.valid_host = True
-                self.status.valid_credentials = True
-                print(f"Requested icon not found: {icon_url}")
-                return
-            else:
-                raise
-        except URLError as e:
-            print(e)
-            self.status.valid_host = False
-            self.status.valid_credentials = False
+        mapped_slug, icon_filename = platform_maps.ES_FOLDER_MAP.get(
+            platform_slug.lower(), (platform_slug, platform_slug)
+        )
+        # Icon may be missing on the server
+        response = self._request(
+            f"{self.host}/{self._platform_icon_url}/{icon_filename}.ico",
+            missing_ok=True,
+        )
+        if response is None:
             return
+        data = response.read()
 
         self.file_system.resources_path = os.getcwd() + "/resources"
-        if not os.path.exists(self.file_system.resources_path):
-            os.makedirs(self.file_system.resources_path)
-
-        with open(f"{self.file_system.resources_path}/{platform_slug}.ico", "wb") as f:
-            f.write(response.read())
+        os.makedirs(self.file_system.resources_path, exist_ok=True)
+        icon_path = f"{self.file_system.resources_path}/{platform_slug}.ico"
 
-        icon = Image.open(f"{self.file_system.resources_path}/{platform_slug}.ico")
+        # Resize in memory and swap the file in whole, the UI may be reading it
+        icon = Image.open(io.BytesIO(data))
         icon = icon.resize((30, 30))
-        icon.save(f"{self.file_system.resources_path}/{platform_slug}.ico")
+        icon.save(f"{icon_path}.tmp", format="ICO")
+        os.replace(f"{icon_path}.tmp", icon_path)
+        self.image_cache.invalidate(icon_path)
         self.status.valid_host = True
         self.status.valid_credentials = True
 
-    def fetch_platforms(self) -> None:
+    def _prefetch_platform_icon(self, platform_slug: str) -> None:
         try:
-            request = Request(
-                f"{self.host}/{self._platforms_endpoint}", headers=self.headers
-            )
-        except ValueError:
-            self.status.platforms = []
-            self.status.valid_host = False
-            self.status.valid_credentials = False
-            return
-        try:
-            if request.type not in ("http", "https"):
-                self.status.platforms = []
-                self.status.valid_host = False
-                self.status.valid_credentials = False
-                return
-            response = urlopen(request, timeout=60)  # trunk-ignore(bandit/B310)
-        except HTTPError as e:
-            print(f"HTTP Error in fetching platforms: {e}")
-            if e.code == 403:
+            self._fetch_platform_icon(platform_slug)
+        except (HTTPError, OSError) as e:
+            print(f"Failed to fetch icon for {platform_slug}: {e}")
+        finally:
+            with self._icons_lock:
+                self._icons_pending.discard(platform_slug)
+
+    def _queue_platform_icons(self, platform_slugs: list[str]) -> None:
+        """Fetch the given platform icons in the background, at most once each."""
+        with self._icons_lock:
+            platform_slugs = [
+                slug for slug in platform_slugs if slug not in self._icons_pending
+            ]
+            self._icons_pending.update(platform_slugs)
+        for slug in platform_slugs:
+            self._icon_executor.submit(self._prefetch_platform_icon, slug)
+
+    def fetch_platforms(self) -> None:
+        url = f"{self.host}/{self._platforms_endpoint}"
+        cached = self.catalog.get(url)
+        if cached is not None:
+            self._load_platforms(cached.data)
+        entry, changed = self._revalidate_catalog(url, cached)
+        if entry is None:
+            if cached is None:
                 self.status.platforms = []
-                self.status.valid_host = True
-                self.status.valid_credentials = False
-                return
-            else:
-                raise
-        except URLError:
-            print("URLError in fetching platforms")
-            self.status.platforms = []
-            self.status.valid_host = False
-            self.status.valid_credentials = False
             return
-        platforms = json.loads(response.read().decode("utf-8"))
+        if changed:
+            self._load_platforms(entry.data)
+
+    def _load_platforms(self, platforms: list[dict]) -> None:
         _platforms: list[Platform] = []
+        missing_icons: list[str] = []
+
+        # Pick up icons that changed on disk since they were cached
+        self.image_cache.revalidate()
 
         # Get the list of subfolders in the ROMs directory for PM filtering
         roms_subfolders = set()
@@ -294,7 +334,7 @@ class API:
                 self.file_system.resources_path = os.getcwd() + "/resources"
                 icon_path = f"{self.file_system.resources_path}/{platform['slug']}.ico"
                 if not os.path.exists(icon_path):
-                    self._fetch_platform_icon(platform["slug"])
+                    missing_icons.append(platform["slug"])
 
         self.status.platforms = _platforms
         print(f"Fetched {len(_platforms)} platforms")
@@ -302,51 +342,32 @@ class API:
         self.status.valid_credentials = True
         self.status.platforms_ready.set()
 
-    def fetch_collections(self) -> None:
-        try:
-            collections_request = Request(
-                f"{self.host}/{self._collections_endpoint}", headers=self.headers
-            )
-            v_collections_request = Request(
-                f"{self.host}/{self._virtual_collections_endpoint}?type={self._collection_type}",
-                headers=self.headers,
-            )
-        except ValueError:
-            self.status.collections = []
-            self.status.valid_host = False
-            self.status.valid_credentials = False
-            return
+        # The list is shown right away, icons pop in as they arrive
+        self._queue_platform_icons(missing_icons)
 
-        try:
-            if collections_request.type not in ("http", "https"):
-                self.status.collections = []
-                self.status.valid_host = False
-                self.status.valid_credentials = False
-                return
-
-            collections_response = urlopen(  # trunk-ignore(bandit/B310)
-                collections_request, timeout=60
-            )
-            v_collections_response = urlopen(  # trunk-ignore(bandit/B310)
-                v_collections_request, timeout=60
-            )
-        except HTTPError as e:
-            if e.code == 403:
-                self.status.collections = []
-                self.status.valid_host = True
-                self.status.valid_credentials = False
+    def fetch_collections(self) -> None:
+        urls = (
+            f"{self.host}/{self._collections_endpoint}",
+            f"{self.host}/{self._virtual_collections_endpoint}?type={self._collection_type}",
+        )
+        cached = [self.catalog.get(url) for url in urls]
+        if cached[0] is not None and cached[1] is not None:
+            self._load_collections(cached[0].data, cached[1].data)
+
+        entries: list[CatalogEntry] = []
+        changed = False
+        for url, cached_entry in zip(urls, cached):
+            entry, entry_changed = self._revalidate_catalog(url, cached_entry)
+            if entry is None:
+                if cached[0] is None or cached[1] is None:
+                    self.status.collections = []
                 return
-            else:
-                raise
-        except URLError:
-            self.status.collections = []
-            self.status.valid_host = False
-            self.status.valid_credentials = False
-            return
-
-        collections = json.loads(collections_response.read().decode("utf-8"))
-        v_collections = json.loads(v_collections_response.read().decode("utf-8"))
+            entries.append(entry)
+            changed = changed or entry_changed
+        if changed:
+            self._load_collections(entries[0].data, entries[1].data)
 
+    def _load_collections(self, collections, v_collections) -> None:
         if isinstance(collections, dict):
             collections = collections["items"]
         if isinstance(v_collections, dict):
@@ -393,55 +414,47 @@ class API:
         self.status.valid_credentials = True
         self.status.collections_ready.set()
 
-    def fetch_roms(self) -> None:
+    def _get_roms_selection(self) -> Optional[Tuple[str, int, Optional[str]]]:
+        """Return the view, id and platform slug of the ROM list being shown."""
         if self.status.selected_platform:
-            view = View.PLATFORMS
-            id = self.status.selected_platform.id
-            selected_platform_slug = self.status.selected_platform.slug.lower()
+            return (
+                View.PLATFORMS,
+                self.status.selected_platform.id,
+                self.status.selected_platform.slug.lower(),
+            )
         elif self.status.selected_collection:
-            view = View.COLLECTIONS
-            id = self.status.selected_collection.id
-            selected_platform_slug = None
+            return View.COLLECTIONS, self.status.selected_collection.id, None
         elif self.status.selected_virtual_collection:
-            view = View.VIRTUAL_COLLECTIONS
-            id = self.status.selected_virtual_collection.id
-            selected_platform_slug = None
-        else:
-            return
-
-        try:
-            request = Request(
-                f"{self.host}/{self._roms_endpoint}?{view}_id={id}&order_by=name&order_dir=asc&limit=10000",
-                headers=self.headers,
+            return (
+                View.VIRTUAL_COLLECTIONS,
+                self.status.selected_virtual_collection.id,
+                None,
             )
-        except ValueError:
-            self.status.roms = []
-            self.status.valid_host = False
-            self.status.valid_credentials = False
+        return None
+
+    def fetch_roms(self) -> None:
+        selection = self._get_roms_selection()
+        if selection is None:
             return
-        try:
-            if request.type not in ("http", "https"):
-                self.status.roms = []
-                self.status.valid_host = False
-                self.status.valid_credentials = False
-                return
-            response = urlopen(request, timeout=1800)  # trunk-ignore(bandit/B310)
-        except HTTPError as e:
-            if e.code == 403:
+        view, id, selected_platform_slug = selection
+
+        url = f"{self.host}/{self._roms_endpoint}?{view}_id={id}&order_by=name&order_dir=asc&limit=10000"
+        cached = self.catalog.get(url)
+        if cached is not None:
+            self._load_roms(cached.data, view, selected_platform_slug)
+        entry, changed = self._revalidate_catalog(url, cached, timeout=1800)
+        if entry is None:
+            if cached is None:
                 self.status.roms = []
-                self.status.valid_host = True
-                self.status.valid_credentials = False
-                return
-            else:
-                raise
-        except URLError:
-            self.status.roms = []
-            self.status.valid_host = False
-            self.status.valid_credentials = False
             return
+        # Don't swap in a list the user already left
+        if changed and self._get_roms_selection() == selection:
+            self._load_roms(entry.data, view, selected_platform_slug)
 
+    def _load_roms(
+        self, roms, view: str, selected_platform_slug: Optional[str]
+    ) -> None:
         # { 'items': list[dict], 'total': number, 'limit': number, 'offset': number }
-        roms = json.loads(response.read().decode("utf-8"))
         if isinstance(roms, dict):
             roms = roms["items"]
 
@@ -492,121 +505,460 @@ class API:
                     regions=rom["regions"],
                     revision=rom["revision"],
                     tags=rom["tags"],
+                    crc_hash=rom.get("crc_hash"),
+                    md5_hash=rom.get("md5_hash"),
+                    sha1_hash=rom.get("sha1_hash"),
+                    files_size_bytes=sum(
+                        file.get("file_size_bytes") or 0
+                        for file in rom.get("files") or []
+                    )
+                    or None,
                 )
             )
 
+        # Rescan local files so changes made outside the app are picked up
+        self.file_system.invalidate_presence()
+        self.file_system.index_platforms({rom.platform_slug for rom in _roms})
+
         self.status.roms = _roms
         self.status.valid_host = True
         self.status.valid_credentials = True
         self.status.roms_ready.set()
 
+    def cleanup(self) -> None:
+        self._icon_executor.shutdown(wait=False, cancel_futures=True)
+        print(f"HTTP session: {self.session.stats()}")
+        print(f"Bandwidth: {self.session.bandwidth.stats()}")
+        self.journal.close()
+        self.session.close()
+
     def _reset_download_status(
         self, valid_host: bool = False, valid_credentials: bool = False
     ) -> None:
-        self.status.total_downloaded_bytes = 0
-        self.status.downloaded_percent = 0.0
         self.status.valid_host = valid_host
         self.status.valid_credentials = valid_credentials
-        self.status.downloading_rom = None
-        self.status.extracting_rom = False
         self.status.multi_selected_roms = []
         self.status.download_queue = []
+        self.status.clear_download_progress()
         self.status.download_rom_ready.set()
         self.status.abort_download.set()
 
-    def download_rom(self) -> None:
-        self.status.download_queue.sort(key=lambda rom: rom.name)
-        for i, rom in enumerate(self.status.download_queue):
-            self.status.downloading_rom = rom
-            self.status.downloading_rom_position = i + 1
-            dest_path = os.path.join(
-                self.file_system.get_platforms_storage_path(rom.platform_slug),
-                self._sanitize_filename(rom.fs_name),
-            )
-            url = f"{self.host}/{self._roms_endpoint}/{rom.id}/content/{quote(rom.fs_name)}?hidden_folder=true"
-            os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+    @staticmethod
+    def _load_partial_download_info(part_path: str, rom: Rom) -> Optional[dict]:
+        """Return the sidecar of a partial download of rom, if it can be resumed."""
+        try:
+            with open(f"{part_path}.json", "r") as f:
+                info = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if (
+            info.get("rom_id") != rom.id
+            or info.get("size") != rom.fs_size_bytes
+            or not (info.get("etag") or info.get("last_modified"))
+        ):
+            return None
+        return info
+
+    def _read_partial_download(
+        self, part_path: str, rom: Rom
+    ) -> tuple[int, Optional[str]]:
+        """
+        Return the size of a resumable partial download of rom and the
+        validator (ETag or Last-Modified) it was started with, or (0, None).
+        """
+        info = self._load_partial_download_info(part_path, rom)
+        try:
+            offset = os.path.getsize(part_path)
+        except OSError:
+            return 0, None
+        if (
+            info is None
+            # Segmented downloads are written out of order
+            or info.get("segments")
+            # A preallocated file that wasn't truncated, nothing tells how far it got
+            or (info.get("length") and offset >= info["length"])
+        ):
+            return 0, None
+        return offset, info.get("etag") or info.get("last_modified")
 
+    @staticmethod
+    def _write_partial_download_info(
+        part_path: str,
+        rom: Rom,
+        headers,
+        length: Optional[int],
+        segments: Optional[list[list[int]]] = None,
+    ) -> None:
+        etag = headers.get("ETag")
+        last_modified = headers.get("Last-Modified")
+        if not etag and not last_modified:
+            # Nothing to validate a resume against, start over next time
+            if os.path.exists(f"{part_path}.json"):
+                os.remove(f"{part_path}.json")
+            return
+        info = {
+            "rom_id": rom.id,
+            "size": rom.fs_size_bytes,
+            "etag": etag,
+            "last_modified": last_modified,
+            "length": length,
+            "segments": segments,
+        }
+        with open(f"{part_path}.json.tmp", "w") as f:
+            json.dump(info, f)
+        os.replace(f"{part_path}.json.tmp", f"{part_path}.json")
+
+    def _open_rom_download(
+        self, url: str, part_path: str, rom: Rom
+    ) -> tuple[Response, int]:
+        """
+        Request the ROM content, continuing a partial download if the server
+        copy didn't change. Returns the response and the offset it starts at.
+        """
+        offset, validator = self._read_partial_download(part_path, rom)
+        if offset and validator:
             try:
-                print(f"Fetching: {url}")
-                request = Request(url, headers=self.headers)
-            except ValueError:
-                self._reset_download_status()
-                return
-            try:
-                if request.type not in ("http", "https"):
-                    self._reset_download_status()
-                    return
-                print(f"Downloading {rom.name} to {dest_path}")
-                with (
-                    urlopen(request) as response,  # trunk-ignore(bandit/B310)
-                    open(dest_path, "wb") as out_file,
-                ):
-                    self.status.total_downloaded_bytes = 0
-                    chunk_size = 1024
-                    while True:
-                        if not self.status.abort_download.is_set():
-                            chunk = response.read(chunk_size)
-                            if not chunk:
-                                print("Finalized download")
-                                break
-                            out_file.write(chunk)
-                            self.status.valid_host = True
-                            self.status.valid_credentials = True
-                            self.status.total_downloaded_bytes += len(chunk)
-                            self.status.downloaded_percent = (
-                                self.status.total_downloaded_bytes
-                                / (
-                                    self.status.downloading_rom.fs_size_bytes + 1
-                                )  # Add 1 virtual byte to avoid division by zero
-                            ) * 100
-                        else:
-                            self._reset_download_status(True, True)
-                            os.remove(dest_path)
-                            return
-                # Handle multi-file (ZIP) ROMs
-                if rom.multi:
-                    self.status.extracting_rom = True
-                    print("Multi file rom detected. Extracting...")
-                    with zipfile.ZipFile(dest_path, "r") as zip_ref:
-                        total_size = sum(file.file_size for file in zip_ref.infolist())
-                        extracted_size = 0
-                        chunk_size = 1024
-                        for file in zip_ref.infolist():
-                            if not self.status.abort_download.is_set():
-                                file_path = os.path.join(
-                                    os.path.dirname(dest_path),
-                                    self._sanitize_filename(file.filename),
-                                )
-                                os.makedirs(os.path.dirname(file_path), exist_ok=True)
-                                with (
-                                    zip_ref.open(file) as source,
-                                    open(file_path, "wb") as target,
-                                ):
-                                    while True:
-                                        chunk = source.read(chunk_size)
-                                        if not chunk:
-                                            break
-                                        target.write(chunk)
-                                        extracted_size += len(chunk)
-                                        self.status.extracted_percent = (
-                                            extracted_size / total_size
-                                        ) * 100
-                            else:
-                                self._reset_download_status(True, True)
-                                os.remove(dest_path)
-                                return
-                    self.status.extracting_rom = False
-                    self.status.downloading_rom = None
-                    os.remove(dest_path)
-                    print(f"Extracted {rom.name} at {os.path.dirname(dest_path)}")
+                response = self.session.get(
+                    url,
+                    headers={"Range": f"bytes={offset}-", "If-Range": validator},
+                    timeout=self.watchdog.read_timeout,
+                    priority=Priority.BULK,
+                )
             except HTTPError as e:
-                if e.code == 403:
-                    self._reset_download_status(valid_host=True)
-                    return
-                else:
+                # The partial file doesn't fit the file on the server anymore
+                if e.code != 416:
                     raise
+            else:
+                content_range = response.headers.get("Content-Range", "")
+                match = re.match(r"bytes (\d+)-", content_range)
+                if response.status == 206 and match and int(match.group(1)) == offset:
+                    print(f"Resuming download at {offset} bytes")
+                    return response, offset
+                if response.status == 200:
+                    # Server copy changed, this is the whole file
+                    return response, 0
+                response.close()
+
+        return (
+            self.session.get(
+                url, timeout=self.watchdog.read_timeout, priority=Priority.BULK
+            ),
+            0,
+        )
+
+    def _download_stream(
+        self,
+        rom: Rom,
+        response: Response,
+        offset: int,
+        part_path: str,
+        copier: StreamCopier,
+        verifier: RomVerifier,
+    ) -> bool:
+        """Write response to part_path from offset on. Returns whether it completed."""
+        if offset:
+            # The resumed part was written by an earlier run
+            verifier.update_from_file(part_path, offset)
+        content_length = response.headers.get("Content-Length")
+        length = offset + int(content_length) if content_length else None
+        with (
+            response,
+            self.watchdog.watch(response, rom.name),
+            open(part_path, "r+b" if offset else "wb") as out_file,
+        ):
+            self._write_partial_download_info(part_path, rom, response.headers, length)
+            if self._preallocate_downloads and length:
+                preallocate(out_file, length)
+            out_file.seek(offset)
+            self.status.set_download_progress(rom, offset)
+
+            try:
+                completed = copier.copy(
+                    response,
+                    out_file,
+                    lambda copied: self.status.set_download_progress(
+                        rom, offset + copied
+                    ),
+                    self.status.abort_download,
+                    verifier.update if verifier.enabled else None,
+                )
+            finally:
+                # Drop any preallocated space past what was written, so a
+                # stalled download resumes from the right offset
+                out_file.truncate()
+        return completed
+
+    def _download_segmented(self, rom: Rom, url: str, part_path: str) -> Optional[bool]:
+        """
+        Download rom over several connections at once. Returns whether it
+        completed, or None if the server can't serve byte ranges of it.
+        """
+        probe = self.session.get(
+            url, headers={"Range": "bytes=0-0"}, priority=Priority.BULK
+        )
+        if probe.status != 206:
+            # Don't read a whole file the server sent instead of the range
+            probe.close()
+            return None
+        probe.read()
+        match = re.match(r"bytes 0-0/(\d+)", probe.headers.get("Content-Range", ""))
+        validator = probe.headers.get("ETag") or probe.headers.get("Last-Modified")
+        if not match or not validator:
+            return None
+        size = int(match.group(1))
+
+        info = self._load_partial_download_info(part_path, rom)
+        if (
+            info is not None
+            and info.get("segments")
+            and (info.get("etag") or info.get("last_modified")) == validator
+            and info.get("length") == size
+            and os.path.exists(part_path)
+        ):
+            segments = info["segments"]
+            print(f"Resuming segmented download of {rom.name}")
+        else:
+            segments = split_segments(size, self._download_segments)
+        done = size - sum(end - start + 1 for start, end in segments if start <= end)
+
+        with open(part_path, "r+b" if done else "wb") as out_file:
+            if self._preallocate_downloads:
+                preallocate(out_file, size)
+            self._write_partial_download_info(
+                part_path, rom, probe.headers, size, segments
+            )
+            download = SegmentedDownload(
+                self.session,
+                url,
+                out_file.fileno(),
+                segments,
+                validator,
+                lambda written: self.status.set_download_progress(rom, done + written),
+                self.status.abort_download,
+                self.watchdog,
+                rom.name,
+            )
+            try:
+                completed = download.run()
+            finally:
+                # Record how far each segment got to resume them later
+                self._write_partial_download_info(
+                    part_path, rom, probe.headers, size, download.segments
+                )
+        return completed
+
+    def _stream_extract_rom(self, rom: Rom, url: str, dest_dir: str) -> Optional[bool]:
+        """
+        Download the zip of a multi-file ROM and extract it on the fly.
+        Returns whether it completed, or None if the archive has to be
+        downloaded whole to be extracted.
+        """
+        extractor = StreamingZipExtractor(dest_dir, self._sanitize_filename)
+        with (
+            self.session.get(
+                url, timeout=self.watchdog.read_timeout, priority=Priority.BULK
+            ) as response,
+            self.watchdog.watch(response, rom.name),
+        ):
+            self.status.valid_host = True
+            self.status.valid_credentials = True
+            try:
+                return extractor.extract(
+                    response,
+                    lambda consumed: self.status.set_download_progress(rom, consumed),
+                    self.status.abort_download,
+                )
+            except StreamingUnsupported as e:
+                print(f"Can't extract {rom.name} while downloading: {e}")
+                extractor.cleanup()
+                return None
+            except (EOFError, ValueError) as e:
+                # Fails this ROM only, the host is fine
+                extractor.cleanup()
+                raise CorruptArchive(f"corrupt archive ({e})") from e
             except URLError:
-                self._reset_download_status(valid_host=True)
-                return
+                # Streamed archives can't be resumed, start over next time
+                extractor.cleanup()
+                raise
+
+    def _download_rom(self, rom: Rom, copier: StreamCopier) -> DownloadResult:
+        """
+        Download and extract a single ROM, see DownloadResult. A download
+        that fails verification is retried from scratch VERIFY_RETRIES times
+        before raising IntegrityError, the last copy is kept with a .bad suffix.
+        """
+        attempt = 0
+        stalls = 0
+        while True:
+            try:
+                return self._download_rom_once(rom, copier)
+            except IntegrityError as e:
+                print(e)
+                attempt += 1
+                if attempt > self._verify_retries:
+                    raise
+                print(f"Downloading {rom.name} again")
+            except TransferStalled as e:
+                if self.status.abort_download.is_set():
+                    return (True, True)
+                stalls += 1
+                if stalls > self._stall_retries:
+                    print(f"Giving up on {rom.name} after {stalls} stalls: {e}")
+                    return (True, False)
+                print(f"Resuming {rom.name} after a stall")
+
+    def _download_rom_once(self, rom: Rom, copier: StreamCopier) -> DownloadResult:
+        self.status.set_download_progress(rom)
+        sd = self._placement.get(rom.id)
+        dest_path = os.path.join(
+            self.file_system.get_platforms_storage_path(rom.platform_slug, sd),
+            self._sanitize_filename(rom.fs_name),
+        )
+        url = f"{self.host}/{self._roms_endpoint}/{rom.id}/content/{quote(rom.fs_name)}?hidden_folder=true"
+        # Content is written here and renamed once complete
+        part_path = f"{dest_path}.part"
+        os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+
+        completed = None
+        verifier = RomVerifier(rom)
+        try:
+            print(f"Fetching: {url}")
+            if rom.multi and self._stream_extract:
+                extracted = self._stream_extract_rom(
+                    rom, url, os.path.dirname(dest_path)
+                )
+                if extracted is not None:
+                    self.file_system.refresh_storage_usage()
+                    self.file_system.invalidate_presence(os.path.dirname(dest_path))
+                    if not extracted:
+                        return (True, True)
+                    print(f"Extracted {rom.name} at {os.path.dirname(dest_path)}")
+                    return None
+            if (
+                self._download_segments > 1
+                and not rom.multi
+                and rom.fs_size_bytes >= self._segmented_download_bytes
+            ):
+                completed = self._download_segmented(rom, url, part_path)
+                if completed:
+                    # Segments arrive out of order, hash the file once complete
+                    verifier.update_from_file(part_path, os.path.getsize(part_path))
+            if completed is None:
+                response, offset = self._open_rom_download(url, part_path, rom)
+        except ValueError:
+            return (False, False)
+        except HTTPError as e:
+            if e.code == 403:
+                return (True, False)
+            else:
+                raise
+        except TransferStalled:
+            raise
+        except URLError:
+            return (True, False)
+        try:
+            if completed is None:
+                print(f"Downloading {rom.name} to {dest_path}")
+                completed = self._download_stream(
+                    rom, response, offset, part_path, copier, verifier
+                )
+            self.status.valid_host = True
+            self.status.valid_credentials = True
+            if not completed:
+                # Keep the partial file to resume it later
+                self.file_system.refresh_storage_usage()
+                return (True, True)
+            # A mismatch is set aside in case the hash is the one that's wrong,
+            # a retry downloads to a new part file
+            bad_path = f"{dest_path}.bad"
+            try:
+                verifier.verify()
+            except IntegrityError:
+                os.replace(part_path, bad_path)
+                if os.path.exists(f"{part_path}.json"):
+                    os.remove(f"{part_path}.json")
+                raise
+            print(f"Finalized download of {rom.name}")
+            os.replace(part_path, dest_path)
+            if os.path.exists(f"{part_path}.json"):
+                os.remove(f"{part_path}.json")
+            if os.path.exists(bad_path):
+                os.remove(bad_path)
+            self.file_system.refresh_storage_usage()
+            if not rom.multi:
+                self.file_system.mark_rom_in_device(rom, sd)
+            # Handle multi-file (ZIP) ROMs
+            if rom.multi:
+                print("Multi file rom detected. Extracting...")
+                self.status.set_download_progress(rom, extracted_percent=0.0)
+                extractor = ZipExtractor(
+                    os.path.dirname(dest_path),
+                    self._sanitize_filename,
+                    preallocate_files=self._preallocate_downloads,
+                )
+                try:
+                    extracted = extractor.extract(
+                        dest_path,
+                        lambda extracted_size, total_size: self.status.set_download_progress(
+                            rom,
+                            extracted_percent=(
+                                extracted_size / total_size * 100
+                                if total_size
+                                else 100.0
+                            ),
+                        ),
+                        self.status.abort_download,
+                    )
+                finally:
+                    # A broken zip isn't kept either
+                    os.remove(dest_path)
+                    self.file_system.refresh_storage_usage()
+                if not extracted:
+                    return (True, True)
+                self.file_system.invalidate_presence(os.path.dirname(dest_path))
+                print(f"Extracted {rom.name} at {os.path.dirname(dest_path)}")
+        except TransferStalled:
+            raise
+        except URLError:
+            return (True, False)
+        return None
+
+    def download_rom(self) -> None:
+        self.status.download_queue[:] = order_queue(
+            self.status.download_queue, self._queue_order
+        )
+        placement = self.file_system.plan_placement(self.status.download_queue)
+        if placement is None:
+            # Space was taken since the batch was queued
+            self.status.show_notice("Error: Not enough free space on SD card")
+            self._reset_download_status(valid_host=True, valid_credentials=True)
+            return
+        self._placement = placement
+        current_sd, *other_sds = self.file_system.get_sd_cards()
+        spilled = sum(1 for sd in placement.values() if sd != current_sd)
+        if spilled:
+            self.status.show_notice(
+                f"SD {current_sd} is full, {spilled} ROM{'s' if spilled > 1 else ''} "
+                f"will go to SD {other_sds[0]}"
+            )
+        self.journal.start_batch(self.status.download_queue)
+        failure = DownloadScheduler(
+            self.status,
+            self._download_rom,
+            journal=self.journal,
+            order=self._queue_order,
+        ).run(self.status.download_queue)
+        if failure is None and not self.status.abort_download.is_set():
+            # Nothing left to resume
+            self.journal.clear()
+        failed = self.status.failed_downloads
+        if len(failed) == 1:
+            rom, reason = failed[0]
+            self.status.show_notice(f"{rom.name} {reason}")
+        elif failed:
+            self.status.show_notice(f"{len(failed)} ROMs failed to download")
+        if failure is not None:
+            self._reset_download_status(*failure)
+            return
         # End of download
         self._reset_download_status(valid_host=True, valid_credentials=True)
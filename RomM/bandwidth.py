@@ -0,0 +1,118 @@
+import os
+import threading
+import time
+from typing import Optional
+
+
+class Priority:
+    INTERACTIVE = "interactive"
+    BULK = "bulk"
+
+
+class TokenBucket:
+    """
+    Token bucket refilled at rate bytes per second, holding up to burst
+    bytes. Consuming more than is available leaves a debt the caller waits
+    out, so large reads don't have to be split.
+    """
+
+    def __init__(self, rate: float, burst: float) -> None:
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def consume(self, n: int, rate: float) -> float:
+        """Take n tokens at rate and return the seconds to wait for them."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(
+                self.burst, self._tokens + (now - self._last) * self.rate
+            )
+            self._last = now
+            self.rate = rate
+            self._tokens -= n
+            return -self._tokens / rate if self._tokens < 0 else 0.0
+
+
+class BandwidthManager:
+    """
+    Shares the link between interactive requests (catalog pages, icons) and
+    bulk transfers (ROM downloads). Bulk reads go through a token bucket
+    limited to BULK_RATE_KBPS, and to BULK_YIELD_RATE_KBPS while interactive
+    requests are transferring or the user is navigating. Interactive reads
+    are never delayed. A rate of 0 means unlimited.
+    """
+
+    _instance: Optional["BandwidthManager"] = None
+
+    # Seconds bulk transfers keep yielding after the last interactive activity
+    yield_time = 1.0
+
+    def __new__(cls):
+        if not cls._instance:
+            cls._instance = super(BandwidthManager, cls).__new__(cls)
+        return cls._instance
+
+    def __init__(self) -> None:
+        if hasattr(self, "_initialized"):
+            return
+
+        self._initialized = True
+        self.bulk_rate = float(os.getenv("BULK_RATE_KBPS", "0")) * 1024
+        self.yield_rate = float(os.getenv("BULK_YIELD_RATE_KBPS", "256")) * 1024
+        self.throttle_browsing = (
+            os.getenv("THROTTLE_WHILE_BROWSING", "true").lower() == "true"
+        )
+
+        rates = [rate for rate in (self.bulk_rate, self.yield_rate) if rate]
+        self._bucket = TokenBucket(max(rates, default=0), max(rates, default=0) / 4)
+        self._lock = threading.Lock()
+        self._last_interactive = 0.0
+        self._last_browsing = 0.0
+
+        self.bytes = {Priority.INTERACTIVE: 0, Priority.BULK: 0}
+        self.throttled_time = 0.0
+
+    def note_interactive(self) -> None:
+        self._last_interactive = time.monotonic()
+
+    def note_browsing(self) -> None:
+        """Called while the user navigates the UI."""
+        if self.throttle_browsing:
+            self._last_browsing = time.monotonic()
+
+    def bulk_limit(self) -> float:
+        """Return the current bulk rate in bytes per second, 0 if unlimited."""
+        now = time.monotonic()
+        yielding = (
+            now - max(self._last_interactive, self._last_browsing) < self.yield_time
+        )
+        rates = [self.bulk_rate] + ([self.yield_rate] if yielding else [])
+        rates = [rate for rate in rates if rate]
+        return min(rates, default=0)
+
+    def consume(self, n: int, priority: str) -> None:
+        """Account for n bytes read, waiting first if bulk traffic is over its rate."""
+        with self._lock:
+            self.bytes[priority] += n
+        if priority == Priority.INTERACTIVE:
+            self.note_interactive()
+            return
+
+        rate = self.bulk_limit()
+        if not rate or not n:
+            return
+        wait = self._bucket.consume(n, rate)
+        if wait > 0:
+            with self._lock:
+                self.throttled_time += wait
+            time.sleep(wait)
+
+    def stats(self) -> str:
+        return (
+            f"{self.bytes[Priority.INTERACTIVE]} interactive bytes, "
+            f"{self.bytes[Priority.BULK]} bulk bytes, "
+            f"bulk throttled for {self.throttled_time:.1f}s"
+        )
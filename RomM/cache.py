@@ -0,0 +1,141 @@
+import os
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+from PIL import Image
+
+
+class ImageCache:
+    """
+    In-memory cache of decoded images, ready to be pasted on the canvas.
+    Entries are kept as RGBA images and evicted least recently used first
+    once the decoded size exceeds the byte budget.
+    """
+
+    _instance: Optional["ImageCache"] = None
+    _initialized: bool = False
+
+    def __new__(cls):
+        if not cls._instance:
+            cls._instance = super(ImageCache, cls).__new__(cls)
+        return cls._instance
+
+    def __init__(self) -> None:
+        if self._initialized:
+            return
+
+        self.max_bytes = int(float(os.getenv("IMAGE_CACHE_MB", "4")) * 1024**2)
+        self._lock = threading.Lock()
+        # path -> (mtime, image or None if it can't be loaded, size in bytes)
+        self._entries: OrderedDict[str, tuple[float, Optional[Image.Image], int]] = (
+            OrderedDict()
+        )
+        self._size = 0
+        # Bumped on invalidation so a load that raced with it isn't cached
+        self._generations: dict[str, int] = {}
+        self._epoch = 0
+        self._initialized = True
+
+    def _load(self, path: str) -> tuple[float, Optional[Image.Image], int]:
+        try:
+            mtime = os.stat(path).st_mtime
+            with Image.open(path) as image:
+                rgba_image = image.convert("RGBA")
+        except (OSError, ValueError):
+            # Missing or unreadable files are cached too, until invalidated
+            return (0.0, None, 0)
+        return (mtime, rgba_image, rgba_image.width * rgba_image.height * 4)
+
+    def get(self, path: str) -> Optional[Image.Image]:
+        """Return the decoded RGBA image at path, or None if it can't be loaded."""
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is not None:
+                self._entries.move_to_end(path)
+                return entry[1]
+            generation = (self._epoch, self._generations.get(path, 0))
+
+        entry = self._load(path)
+
+        with self._lock:
+            if generation != (self._epoch, self._generations.get(path, 0)):
+                # The file changed while it was loaded, decode it again on next use
+                return entry[1]
+            previous = self._entries.pop(path, None)
+            if previous is not None:
+                self._size -= previous[2]
+            self._entries[path] = entry
+            self._size += entry[2]
+
+            while self._size > self.max_bytes and len(self._entries) > 1:
+                _path, (_mtime, _image, size) = self._entries.popitem(last=False)
+                self._size -= size
+
+        return entry[1]
+
+    def invalidate(self, path: str) -> None:
+        """Drop the cached image for path, it will be decoded again on next use."""
+        with self._lock:
+            self._generations[path] = self._generations.get(path, 0) + 1
+            entry = self._entries.pop(path, None)
+            if entry is not None:
+                self._size -= entry[2]
+
+    def revalidate(self) -> None:
+        """Drop entries whose file changed on disk since they were decoded."""
+        with self._lock:
+            entries = list(self._entries.items())
+
+        for path, (mtime, _image, _size) in entries:
+            try:
+                current_mtime = os.stat(path).st_mtime
+            except OSError:
+                current_mtime = 0.0
+            if current_mtime != mtime:
+                self.invalidate(path)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._epoch += 1
+            self._entries.clear()
+            self._size = 0
+
+
+class TextCache:
+    """
+    Bounded LRU of pre-rendered text sprites.
+    Counts hits and misses so the effect on frame times can be checked.
+    """
+
+    def __init__(self, max_entries: int) -> None:
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[tuple, tuple[tuple[int, int], Image.Image]] = (
+            OrderedDict()
+        )
+
+    def get(self, key: tuple) -> Optional[tuple[tuple[int, int], Image.Image]]:
+        """Return the (offset, sprite) cached for key, or None on a miss."""
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return entry
+
+    def put(self, key: tuple, entry: tuple[tuple[int, int], Image.Image]) -> None:
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def stats(self) -> str:
+        lookups = self.hits + self.misses
+        hit_rate = (self.hits / lookups * 100) if lookups else 0.0
+        return (
+            f"{self.hits} hits, {self.misses} misses ({hit_rate:.1f}% hit rate), "
+            f"{len(self._entries)}/{self.max_entries} sprites"
+        )
@@ -0,0 +1,79 @@
+import hashlib
+import json
+import os
+from typing import Any, NamedTuple, Optional
+
+from session import Response
+
+
+class CatalogEntry(NamedTuple):
+    data: Any
+    etag: Optional[str]
+    last_modified: Optional[str]
+    # Hash of the body, to tell a changed catalog apart when the server has no validators
+    digest: str
+
+
+class CatalogCache:
+    """
+    On-disk copies of the catalog JSON (platforms, collections, ROM lists),
+    keyed by user and URL, so lists can be shown before the server answers.
+    Each copy keeps the ETag and Last-Modified it was served with to
+    revalidate it with a conditional request. Copies are replaced atomically,
+    a torn file just reads as a miss.
+    """
+
+    def __init__(self, path: str, user: str = "") -> None:
+        self.path = path
+        self.user = user
+        self.enabled = os.getenv("CATALOG_CACHE", "true").lower() == "true"
+
+    def _entry_path(self, url: str) -> str:
+        key = hashlib.sha1(f"{self.user}@{url}".encode("utf-8")).hexdigest()
+        return os.path.join(self.path, f"{key}.json")
+
+    def get(self, url: str) -> Optional[CatalogEntry]:
+        if not self.enabled:
+            return None
+        try:
+            with open(self._entry_path(url), "r") as f:
+                record = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if record.get("url") != url:
+            return None
+        return CatalogEntry(
+            record["data"], record["etag"], record["last_modified"], record["digest"]
+        )
+
+    @staticmethod
+    def validators(entry: Optional[CatalogEntry]) -> dict[str, str]:
+        """Return the headers that make a request for entry conditional."""
+        headers = {}
+        if entry is not None and entry.etag:
+            headers["If-None-Match"] = entry.etag
+        if entry is not None and entry.last_modified:
+            headers["If-Modified-Since"] = entry.last_modified
+        return headers
+
+    def put(self, url: str, body: bytes, response: Response) -> CatalogEntry:
+        """Parse a catalog response body and store it for url."""
+        entry = CatalogEntry(
+            json.loads(body.decode("utf-8")),
+            response.headers.get("ETag"),
+            response.headers.get("Last-Modified"),
+            hashlib.sha1(body).hexdigest(),
+        )
+        if not self.enabled:
+            return entry
+
+        entry_path = self._entry_path(url)
+        tmp_path = f"{entry_path}.tmp"
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            with open(tmp_path, "w") as f:
+                json.dump({"url": url, **entry._asdict()}, f)
+            os.replace(tmp_path, entry_path)
+        except OSError as e:
+            print(f"Failed to cache {url}: {e}")
+        return entry
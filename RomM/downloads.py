@@ -0,0 +1,138 @@
+import os
+import threading
+from typing import Callable, Optional
+
+from journal import DownloadJournal
+from models import Rom
+from status import Status
+from transfer import StreamCopier, create_copier
+from verify import IntegrityError
+
+# Outcome of a single ROM download: None once it's on the device, otherwise
+# the (valid_host, valid_credentials) state the download status is reset with
+DownloadResult = Optional[tuple[bool, bool]]
+
+
+class QueueOrder:
+    # Alphabetical, as shown in the ROM list
+    NAME = "name"
+    # Most ROMs completed per minute
+    SMALLEST = "smallest"
+    # Request latency hidden behind long transfers
+    LARGEST = "largest"
+    # One platform directory at a time
+    PLATFORM = "platform"
+    # A large ROM in flight while the other workers go through small ones
+    INTERLEAVE = "interleave"
+
+
+def order_queue(roms: list[Rom], order: str) -> list[Rom]:
+    """Return roms in the order they are downloaded with the given policy."""
+    if order == QueueOrder.SMALLEST:
+        return sorted(roms, key=lambda rom: (rom.fs_size_bytes, rom.name))
+    if order in (QueueOrder.LARGEST, QueueOrder.INTERLEAVE):
+        return sorted(roms, key=lambda rom: (-rom.fs_size_bytes, rom.name))
+    if order == QueueOrder.PLATFORM:
+        return sorted(roms, key=lambda rom: (rom.platform_slug, rom.name))
+    return sorted(roms, key=lambda rom: rom.name)
+
+
+class DownloadScheduler:
+    """
+    Works through a download queue with several ROMs in flight, so small
+    ROMs don't wait on each other's request latency. The first failure or
+    an abort stops the remaining transfers, except for ROMs failing
+    verification or with an unexpected error (a server error, a full SD
+    card, a broken zip) which are only marked as failed. The queue is expected in
+    the order of QUEUE_ORDER, with the interleave order half of the workers
+    take the largest ROMs left and the others the smallest.
+    """
+
+    def __init__(
+        self,
+        status: Status,
+        download: Callable[[Rom, StreamCopier], DownloadResult],
+        workers: Optional[int] = None,
+        journal: Optional[DownloadJournal] = None,
+        order: str = QueueOrder.NAME,
+    ) -> None:
+        self.status = status
+        self.download = download
+        self.journal = journal
+        self.order = order
+        self.workers = workers or int(os.getenv("DOWNLOAD_WORKERS", "3"))
+        self.failure: DownloadResult = None
+        self._pending: list[Rom] = []
+        # IDs of the large ROMs in flight with the interleave order
+        self._large_in_flight: set[int] = set()
+        self._lock = threading.Lock()
+
+    def _next_rom(self) -> Optional[Rom]:
+        with self._lock:
+            if (
+                not self._pending
+                or self.failure is not None
+                or self.status.abort_download.is_set()
+            ):
+                return None
+            if self.order != QueueOrder.INTERLEAVE:
+                return self._pending.pop(0)
+            if len(self._large_in_flight) < max(1, self.workers // 2):
+                rom = self._pending.pop(0)
+                self._large_in_flight.add(rom.id)
+                return rom
+            return self._pending.pop()
+
+    def _fail(self, result: tuple[bool, bool]) -> None:
+        with self._lock:
+            if self.failure is None:
+                self.failure = result
+        # Stop the transfers of the other workers
+        self.status.abort_download.set()
+
+    def _fail_rom(self, rom: Rom, reason: str) -> None:
+        self.status.fail_download(rom, reason)
+        self.status.show_notice(f"{rom.name} {reason}")
+        # Don't retry it when the batch is resumed
+        if self.journal is not None:
+            self.journal.failed(rom)
+
+    def _work(self) -> None:
+        # Each worker copies through its own buffers
+        copier = create_copier()
+        while (rom := self._next_rom()) is not None:
+            if self.journal is not None:
+                self.journal.started(rom)
+            try:
+                result = self.download(rom, copier)
+            except IntegrityError:
+                self._fail_rom(rom, "failed verification, kept as .bad")
+                continue
+            except Exception as e:
+                print(f"Failed to download {rom.name}: {e!r}")
+                reason = e.strerror if isinstance(e, OSError) and e.strerror else e
+                self._fail_rom(rom, f"failed: {reason or type(e).__name__}")
+                continue
+            finally:
+                with self._lock:
+                    self._large_in_flight.discard(rom.id)
+            if result is not None:
+                self._fail(result)
+                return
+            self.status.finish_download(rom)
+            if self.journal is not None:
+                self.journal.completed(rom)
+
+    def run(self, roms: list[Rom]) -> DownloadResult:
+        """Download roms in order and return the first failure, if any."""
+        self._pending = list(roms)
+        self.status.start_downloads(roms)
+        threads = [
+            threading.Thread(target=self._work, daemon=True)
+            for _ in range(min(self.workers, len(roms)))
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return self.failure
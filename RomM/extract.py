@@ -0,0 +1,395 @@
+import os
+import struct
+import threading
+import time
+import zipfile
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Optional, cast
+
+from transfer import preallocate
+
+_LOCAL_FILE_HEADER = b"PK\x03\x04"
+_CENTRAL_DIRECTORY_HEADER = b"PK\x01\x02"
+_END_OF_CENTRAL_DIRECTORY = b"PK\x05\x06"
+_DATA_DESCRIPTOR = b"PK\x07\x08"
+
+_ZIP_STORED = 0
+_ZIP_DEFLATED = 8
+
+# General purpose flags
+_FLAG_ENCRYPTED = 0x1
+_FLAG_DATA_DESCRIPTOR = 0x8
+
+
+class StreamingUnsupported(Exception):
+    """The archive can't be extracted without its central directory."""
+
+
+class CorruptArchive(Exception):
+    """The archive is truncated or damaged."""
+
+
+def member_path(base_dir: str, filename: str, sanitize: Callable[[str], str]) -> str:
+    """
+    Return where the zip member filename is extracted to under base_dir.
+    Raises ValueError for names that would end up outside of it.
+    """
+    path = os.path.join(base_dir, sanitize(filename))
+    base = os.path.realpath(base_dir)
+    if os.path.commonpath([base, os.path.realpath(path)]) != base:
+        raise ValueError(f"Refusing to extract {filename} outside of {base_dir}")
+    return path
+
+
+class _StreamReader:
+    """Buffered reads of exact sizes over a stream with a readinto method."""
+
+    def __init__(self, source, buffer_size: int) -> None:
+        self.source = source
+        self._chunk = memoryview(bytearray(buffer_size))
+        self._pending = bytearray()
+        self.consumed = 0
+
+    def _fill(self) -> bool:
+        n = self.source.readinto(self._chunk)
+        if not n:
+            return False
+        self._pending += self._chunk[:n]
+        return True
+
+    def read_exact(self, size: int) -> bytearray:
+        while len(self._pending) < size:
+            if not self._fill():
+                raise EOFError("Archive ended unexpectedly")
+        data = self._pending[:size]
+        del self._pending[:size]
+        self.consumed += size
+        return data
+
+    def read_some(self, max_size: int) -> bytearray:
+        """Return up to max_size bytes, at least one unless the stream ended."""
+        if not self._pending and not self._fill():
+            return bytearray()
+        data = self._pending[:max_size]
+        del self._pending[: len(data)]
+        self.consumed += len(data)
+        return data
+
+    def unread(self, data: bytes) -> None:
+        self._pending[:0] = data
+        self.consumed -= len(data)
+
+
+class StreamingZipExtractor:
+    """
+    Extracts a zip archive from its local file headers while it is being
+    downloaded, so the archive itself is never written to disk. Archives
+    that need the central directory (encrypted members, unsupported
+    compression or stored members of unknown size) raise StreamingUnsupported.
+    """
+
+    def __init__(
+        self,
+        base_dir: str,
+        sanitize: Callable[[str], str],
+        buffer_size: Optional[int] = None,
+    ) -> None:
+        if buffer_size is None:
+            buffer_size = int(os.getenv("DOWNLOAD_BUFFER_KB", "256")) * 1024
+        self.base_dir = base_dir
+        self.sanitize = sanitize
+        self.buffer_size = buffer_size
+        # Files written so far, to clean up after a fallback
+        self.written_paths: list[str] = []
+
+    def _read_header(self, reader: _StreamReader) -> Optional[tuple]:
+        signature = reader.read_exact(4)
+        if signature in (_CENTRAL_DIRECTORY_HEADER, _END_OF_CENTRAL_DIRECTORY):
+            return None
+        if signature != _LOCAL_FILE_HEADER:
+            raise StreamingUnsupported("Unexpected data between zip members")
+
+        (
+            _version,
+            flags,
+            method,
+            _time,
+            _date,
+            crc,
+            compressed_size,
+            size,
+            name_length,
+            extra_length,
+        ) = struct.unpack("<HHHHHIIIHH", reader.read_exact(26))
+        filename = reader.read_exact(name_length).decode(
+            "utf-8" if flags & 0x800 else "cp437"
+        )
+        extra = reader.read_exact(extra_length)
+
+        zip64 = False
+        position = 0
+        while position + 4 <= len(extra):
+            header_id, data_size = struct.unpack_from("<HH", extra, position)
+            if header_id == 0x0001:
+                zip64 = True
+                values = extra[position + 4 : position + 4 + data_size]
+                if size == 0xFFFFFFFF and len(values) >= 8:
+                    (size,) = struct.unpack_from("<Q", values, 0)
+                    values = values[8:]
+                if compressed_size == 0xFFFFFFFF and len(values) >= 8:
+                    (compressed_size,) = struct.unpack_from("<Q", values, 0)
+            position += 4 + data_size
+
+        if flags & _FLAG_ENCRYPTED:
+            raise StreamingUnsupported(f"{filename} is encrypted")
+        if method not in (_ZIP_STORED, _ZIP_DEFLATED):
+            raise StreamingUnsupported(f"{filename} uses compression method {method}")
+        has_descriptor = bool(flags & _FLAG_DATA_DESCRIPTOR)
+        if method == _ZIP_STORED and has_descriptor and not compressed_size:
+            raise StreamingUnsupported(f"Size of {filename} is only in the directory")
+        return filename, method, crc, compressed_size, has_descriptor, zip64
+
+    def _read_descriptor(self, reader: _StreamReader, zip64: bool) -> int:
+        """Read the data descriptor following a member and return its CRC."""
+        data = reader.read_exact(4)
+        if data == _DATA_DESCRIPTOR:
+            data = reader.read_exact(4)
+        (crc,) = struct.unpack("<I", data)
+        reader.read_exact(16 if zip64 else 8)
+        return crc
+
+    def _extract_member(
+        self,
+        reader: _StreamReader,
+        target,
+        method: int,
+        compressed_size: int,
+        has_descriptor: bool,
+        abort: Optional[threading.Event],
+        on_progress: Callable[[int], None],
+    ) -> tuple[bool, int]:
+        """Write one member to target. Returns whether it completed and its CRC."""
+        crc = 0
+        decompressor = zlib.decompressobj(-15) if method == _ZIP_DEFLATED else None
+        # Deflated members with a data descriptor end where the stream ends
+        remaining = None if decompressor and has_descriptor else compressed_size
+
+        while remaining is None or remaining > 0:
+            if abort is not None and abort.is_set():
+                return False, crc
+            max_size = self.buffer_size if remaining is None else remaining
+            chunk = reader.read_some(min(self.buffer_size, max_size))
+            if not chunk:
+                raise EOFError("Archive ended unexpectedly")
+            if remaining is not None:
+                remaining -= len(chunk)
+
+            if decompressor is None:
+                target.write(chunk)
+                crc = zlib.crc32(chunk, crc)
+            else:
+                # Bound each output, a compressible member would inflate in memory
+                data = decompressor.decompress(chunk, self.buffer_size)
+                while True:
+                    target.write(data)
+                    crc = zlib.crc32(data, crc)
+                    if decompressor.eof or (
+                        len(data) < self.buffer_size
+                        and not decompressor.unconsumed_tail
+                    ):
+                        break
+                    data = decompressor.decompress(
+                        decompressor.unconsumed_tail, self.buffer_size
+                    )
+                if decompressor.eof and decompressor.unused_data:
+                    reader.unread(decompressor.unused_data)
+            on_progress(reader.consumed)
+
+            if decompressor is not None and decompressor.eof:
+                break
+        return True, crc
+
+    def extract(
+        self,
+        source,
+        on_progress: Callable[[int], None],
+        abort: Optional[threading.Event] = None,
+    ) -> bool:
+        """
+        Extract every member of the archive read from source, calling
+        on_progress with the number of archive bytes read so far.
+        Returns False if aborted.
+        """
+        reader = _StreamReader(source, self.buffer_size)
+        while True:
+            header = self._read_header(reader)
+            if header is None:
+                break
+            filename, method, crc, compressed_size, has_descriptor, zip64 = header
+
+            path = member_path(self.base_dir, filename, self.sanitize)
+            if filename.endswith("/"):
+                os.makedirs(path, exist_ok=True)
+                continue
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+            self.written_paths.append(path)
+            with open(path, "wb") as target:
+                completed, actual_crc = self._extract_member(
+                    reader,
+                    target,
+                    method,
+                    compressed_size,
+                    has_descriptor,
+                    abort,
+                    on_progress,
+                )
+            if not completed:
+                # Don't leave a truncated member behind
+                os.remove(path)
+                self.written_paths.pop()
+                return False
+
+            if has_descriptor:
+                crc = self._read_descriptor(reader, zip64)
+            if actual_crc != crc:
+                raise ValueError(f"CRC mismatch extracting {filename}")
+
+        # Drain the central directory so the connection can be reused
+        while reader.read_some(self.buffer_size):
+            pass
+        on_progress(reader.consumed)
+        return True
+
+    def cleanup(self) -> None:
+        """Remove the files extracted so far."""
+        for path in self.written_paths:
+            if os.path.exists(path):
+                os.remove(path)
+        self.written_paths = []
+
+
+class ZipExtractor:
+    """
+    Extracts a zip file on disk with a few threads, one member per thread,
+    since zlib releases the GIL while inflating. Every thread copies through
+    its own reusable buffer and progress is reported at most every
+    progress_interval seconds.
+    """
+
+    def __init__(
+        self,
+        base_dir: str,
+        sanitize: Callable[[str], str],
+        workers: Optional[int] = None,
+        buffer_size: Optional[int] = None,
+        preallocate_files: bool = False,
+        progress_interval: float = 0.1,
+    ) -> None:
+        if workers is None:
+            workers = int(os.getenv("EXTRACT_WORKERS", "2"))
+        if buffer_size is None:
+            buffer_size = int(os.getenv("DOWNLOAD_BUFFER_KB", "256")) * 1024
+        self.base_dir = base_dir
+        self.sanitize = sanitize
+        self.workers = max(1, workers)
+        self.buffer_size = buffer_size
+        self.preallocate_files = preallocate_files
+        self.progress_interval = progress_interval
+
+        self._buffers = threading.local()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._last_report = 0.0
+        self.extracted = 0
+        self.total = 0
+
+    def _buffer(self) -> memoryview:
+        view = getattr(self._buffers, "view", None)
+        if view is None:
+            view = memoryview(bytearray(self.buffer_size))
+            self._buffers.view = view
+        return view
+
+    def _add_progress(self, n: int, on_progress: Callable[[int, int], None]) -> None:
+        with self._lock:
+            self.extracted += n
+            now = time.monotonic()
+            if now - self._last_report < self.progress_interval:
+                return
+            self._last_report = now
+        on_progress(self.extracted, self.total)
+
+    def _extract_member(
+        self,
+        zip_ref: zipfile.ZipFile,
+        info: zipfile.ZipInfo,
+        path: str,
+        on_progress: Callable[[int, int], None],
+        abort: Optional[threading.Event],
+    ) -> bool:
+        """Write one member to path. Returns False if stopped before the end."""
+        view = self._buffer()
+        try:
+            # ZipFile.open is typed as returning IO[bytes], which has no readinto
+            source = cast(zipfile.ZipExtFile, zip_ref.open(info))
+            with source, open(path, "wb") as target:
+                if self.preallocate_files:
+                    preallocate(target, info.file_size)
+                while True:
+                    if self._stop.is_set() or (abort is not None and abort.is_set()):
+                        break
+                    n = source.readinto(view)
+                    if not n:
+                        target.truncate()
+                        return True
+                    target.write(view[:n])
+                    self._add_progress(n, on_progress)
+        except BaseException:
+            self._stop.set()
+            if os.path.exists(path):
+                os.remove(path)
+            raise
+        # Don't leave a truncated member behind
+        os.remove(path)
+        return False
+
+    def extract(
+        self,
+        zip_path: str,
+        on_progress: Callable[[int, int], None],
+        abort: Optional[threading.Event] = None,
+    ) -> bool:
+        """
+        Extract every member of zip_path under base_dir, calling on_progress
+        with the bytes extracted so far and the total. Returns False if
+        aborted, raises the error of a member that couldn't be written.
+        """
+        with zipfile.ZipFile(zip_path, "r") as zip_ref:
+            members = []
+            for info in zip_ref.infolist():
+                path = member_path(self.base_dir, info.filename, self.sanitize)
+                if info.is_dir():
+                    os.makedirs(path, exist_ok=True)
+                    continue
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                members.append((info, path))
+            self.total = sum(info.file_size for info, _path in members)
+
+            # Largest members first so a big disc doesn't start last
+            members.sort(key=lambda member: member[0].file_size, reverse=True)
+            with ThreadPoolExecutor(
+                max_workers=self.workers, thread_name_prefix="extract"
+            ) as executor:
+                futures = [
+                    executor.submit(
+                        self._extract_member, zip_ref, info, path, on_progress, abort
+                    )
+                    for info, path in members
+                ]
+            # Every member is done here, raise the first error if any
+            completed = all([future.result() for future in futures])
+
+        on_progress(self.extracted, self.total)
+        return completed
@@ -1,8 +1,10 @@
 import os
+import shutil
+import threading
 from typing import Optional
 
 import platform_maps
-from models import Rom
+from models import Rom, StorageUsage
 
 
 class Filesystem:
@@ -59,6 +61,33 @@ class Filesystem:
             )
         )
 
+        # Storage usage snapshots keyed by ROMs storage path, sampled in the background
+        if not hasattr(self, "_storage_usage"):
+            self._storage_usage: dict[str, StorageUsage] = {}
+            self._storage_lock = threading.Lock()
+            self._storage_refresh = threading.Event()
+            self._storage_monitor: Optional[threading.Thread] = None
+        self._storage_monitor_interval = float(
+            os.getenv("STORAGE_MONITOR_INTERVAL", "10")
+        )
+
+        # Downloads that don't fit on the current SD card go to the other one
+        self._sd_spillover = os.getenv("SD_SPILLOVER", "true").lower() == "true"
+        # Same setting as the API's, multi-file ROM zips aren't stored when set
+        self._stream_extract = os.getenv("STREAM_EXTRACT", "true").lower() == "true"
+        # Space left free on each SD card when placing downloads
+        self._sd_reserve_bytes = int(os.getenv("SD_RESERVE_MB", "64")) * 1024**2
+
+        # Resolved platform directories per (SD card, platform)
+        self._platform_paths: dict[tuple[int, str], str] = {}
+
+        # Names of the entries in each scanned platform directory
+        if not hasattr(self, "_presence_index"):
+            self._presence_index: dict[str, set[str]] = {}
+            self._presence_lock = threading.Lock()
+            # Bumped whenever the index changes so views can cache filtered lists
+            self.presence_version = 0
+
     ###
     # PRIVATE METHODS
     ###
@@ -111,10 +140,157 @@ class Filesystem:
             return os.path.join(self._sd2_roms_storage_path, platforms_dir)
         return None
 
+    def _sample_storage_usage(self) -> None:
+        """Sample free and used space for both SD cards."""
+        for storage_path in (self._sd1_roms_storage_path, self._sd2_roms_storage_path):
+            if not storage_path:
+                continue
+            try:
+                total, used, free = shutil.disk_usage(storage_path)
+            except OSError:
+                with self._storage_lock:
+                    self._storage_usage.pop(storage_path, None)
+                continue
+            with self._storage_lock:
+                self._storage_usage[storage_path] = StorageUsage(total, used, free)
+
+    def _get_rom_location(self, rom: Rom, sd: Optional[int] = None) -> tuple[str, str]:
+        """Return the platform directory and the entry name marking a ROM as present."""
+        return (
+            self.get_platforms_storage_path(rom.platform_slug, sd),
+            rom.fs_name if not rom.multi else f"{rom.fs_name}.m3u",
+        )
+
+    def _get_presence(self, platform_path: str) -> set[str]:
+        """Return the entry names in a platform directory, scanning it once."""
+        with self._presence_lock:
+            names = self._presence_index.get(platform_path)
+        if names is not None:
+            return names
+
+        try:
+            with os.scandir(platform_path) as entries:
+                names = {entry.name for entry in entries}
+        except OSError:
+            names = set()
+
+        with self._presence_lock:
+            # Another thread may have scanned or updated it meanwhile
+            return self._presence_index.setdefault(platform_path, names)
+
+    def _monitor_storage(self) -> None:
+        while True:
+            self._storage_refresh.clear()
+            self._sample_storage_usage()
+            self._storage_refresh.wait(self._storage_monitor_interval)
+
     ###
     # PUBLIC METHODS
     ###
 
+    def start_storage_monitor(self) -> None:
+        """Start sampling storage usage on a background timer."""
+        if self._storage_monitor and self._storage_monitor.is_alive():
+            return
+        self._storage_monitor = threading.Thread(
+            target=self._monitor_storage, daemon=True
+        )
+        self._storage_monitor.start()
+
+    def refresh_storage_usage(self) -> None:
+        """Ask the storage monitor to sample again, e.g. after files were written."""
+        self._storage_refresh.set()
+
+    def get_storage_usage(self, sd: Optional[int] = None) -> Optional[StorageUsage]:
+        """Return the last storage usage snapshot for an SD card, the current one by default."""
+        storage_path = self.get_roms_storage_path(sd)
+        with self._storage_lock:
+            usage = self._storage_usage.get(storage_path)
+        if usage is None and not (
+            self._storage_monitor and self._storage_monitor.is_alive()
+        ):
+            # No monitor running yet, sample once synchronously
+            self._sample_storage_usage()
+            with self._storage_lock:
+                usage = self._storage_usage.get(storage_path)
+        return usage
+
+    def get_sd_cards(self) -> list[int]:
+        """Return the SD cards ROMs can be stored on, the current one first."""
+        other = 2 if self._current_sd == 1 else 1
+        if other == 2 and not self._sd2_roms_storage_path:
+            return [self._current_sd]
+        return [self._current_sd, other]
+
+    @staticmethod
+    def get_installed_size(rom: Rom) -> int:
+        """Return the space rom takes on an SD card once downloaded."""
+        if rom.multi and rom.files_size_bytes:
+            return rom.files_size_bytes
+        return rom.fs_size_bytes
+
+    def get_download_size(self, rom: Rom, sd: Optional[int] = None) -> int:
+        """
+        Return the space downloading rom needs on an SD card at its peak.
+        Multi-file ROMs hold their zip and the extracted files at once unless
+        they are extracted while downloading, bytes already in a part file
+        from an earlier attempt aren't counted.
+        """
+        if rom.multi:
+            installed = self.get_installed_size(rom)
+            return installed if self._stream_extract else installed + rom.fs_size_bytes
+        # The part name skips the sanitizing the download does, a miss only overestimates
+        part_path = os.path.join(
+            self.get_platforms_storage_path(rom.platform_slug, sd),
+            f"{rom.fs_name}.part",
+        )
+        try:
+            partial = os.path.getsize(part_path)
+        except OSError:
+            partial = 0
+        return max(rom.fs_size_bytes - partial, 0)
+
+    def plan_placement(self, roms: list[Rom]) -> Optional[dict[int, int]]:
+        """
+        Choose the SD card each ROM of a batch is downloaded to, by ROM id.
+        ROMs fill the current SD card in queue order and, with SD_SPILLOVER,
+        the ones that don't fit go to the other card. Returns None if the
+        batch doesn't fit, so it can be refused before anything is written.
+        """
+        # The monitor's snapshot may be several seconds old
+        self._sample_storage_usage()
+        free: dict[int, Optional[int]] = {}
+        for sd in self.get_sd_cards() if self._sd_spillover else [self._current_sd]:
+            usage = self.get_storage_usage(sd)
+            if usage is None and sd != self._current_sd:
+                # Don't spill to a card that can't be sampled
+                continue
+            free[sd] = None if usage is None else usage.free - self._sd_reserve_bytes
+
+        placement: dict[int, int] = {}
+        for rom in roms:
+            sizes = {sd: self.get_download_size(rom, sd) for sd in free}
+            # A card holding part of the ROM already comes first, to resume it there
+            for sd in sorted(free, key=sizes.__getitem__):
+                available = free[sd]
+                if available is None:
+                    # If the storage can't be sampled let the download report the error
+                    placement[rom.id] = sd
+                    break
+                size = sizes[sd]
+                if size <= available:
+                    placement[rom.id] = sd
+                    # Only the extracted files stay once a multi-file ROM is done
+                    free[sd] = available - min(size, self.get_installed_size(rom))
+                    break
+            else:
+                print(
+                    f"Not enough free space for {rom.name} "
+                    f"({self.get_installed_size(rom)} bytes) on SD {', '.join(map(str, free))}"
+                )
+                return None
+        return placement
+
     def switch_sd_storage(self) -> None:
         """Switch the current SD storage path."""
         if self._current_sd == 1:
@@ -122,26 +298,69 @@ class Filesystem:
         else:
             self._current_sd = 1
 
-    def get_roms_storage_path(self) -> str:
-        """Return the current SD storage path."""
-        if self._current_sd == 2 and self._sd2_roms_storage_path:
+    def get_roms_storage_path(self, sd: Optional[int] = None) -> str:
+        """Return the storage path of an SD card, the current one by default."""
+        if sd is None:
+            sd = self._current_sd
+        if sd == 2 and self._sd2_roms_storage_path:
             return self._sd2_roms_storage_path
 
         return self._sd1_roms_storage_path
 
-    def get_platforms_storage_path(self, platform: str) -> str:
-        """Return the storage path for a specific platform."""
-        if self._current_sd == 2:
+    def get_platforms_storage_path(
+        self, platform: str, sd: Optional[int] = None
+    ) -> str:
+        """Return the storage path for a specific platform, on the current SD card by default."""
+        if sd is None:
+            sd = self._current_sd
+        key = (sd, platform)
+        storage_path = self._platform_paths.get(key)
+        if storage_path:
+            return storage_path
+
+        if sd == 2:
             storage_path = self._get_sd2_platforms_storage_path(platform)
-            if storage_path:
-                return storage_path
+        if not storage_path:
+            storage_path = self._get_sd1_platforms_storage_path(platform)
 
-        return self._get_sd1_platforms_storage_path(platform)
+        self._platform_paths[key] = storage_path
+        return storage_path
 
     def is_rom_in_device(self, rom: Rom) -> bool:
         """Check if a ROM exists in the storage path."""
-        rom_path = os.path.join(
-            self.get_platforms_storage_path(rom.platform_slug),
-            rom.fs_name if not rom.multi else f"{rom.fs_name}.m3u",
-        )
-        return os.path.exists(rom_path)
+        platform_path, name = self._get_rom_location(rom)
+        names = self._get_presence(platform_path)
+        with self._presence_lock:
+            return name in names
+
+    def mark_rom_in_device(self, rom: Rom, sd: Optional[int] = None) -> None:
+        """Record a ROM written to the storage path of an SD card."""
+        platform_path, name = self._get_rom_location(rom, sd)
+        with self._presence_lock:
+            names = self._presence_index.get(platform_path)
+            if names is not None:
+                names.add(name)
+            self.presence_version += 1
+
+    def mark_rom_removed(self, rom: Rom) -> None:
+        """Record a ROM removed from the storage path."""
+        platform_path, name = self._get_rom_location(rom)
+        with self._presence_lock:
+            names = self._presence_index.get(platform_path)
+            if names is not None:
+                names.discard(name)
+            self.presence_version += 1
+
+    def index_platforms(self, platform_slugs: set[str]) -> None:
+        """Scan the directories of the given platforms ahead of the first lookup."""
+        for platform_slug in platform_slugs:
+            self._get_presence(self.get_platforms_storage_path(platform_slug))
+
+    def invalidate_presence(self, platform_path: Optional[str] = None) -> None:
+        """Forget scanned directories so they are scanned again on next lookup."""
+        with self._presence_lock:
+            if platform_path is None:
+                self._presence_index.clear()
+            else:
+                self._presence_index.pop(platform_path, None)
+            self.presence_version += 1
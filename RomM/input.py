@@ -1,6 +1,8 @@
+import ctypes
 import os
 import time
-from threading import Lock
+from collections import deque
+from threading import Condition, Lock
 from typing import Any, Dict, Optional
 
 import sdl2
@@ -46,6 +48,13 @@ class Input:
         self._initialized = True
         self._input_lock = Lock()
 
+        # SDL events waiting to be applied on the main thread
+        self._events: deque[sdl2.SDL_Event] = deque()
+        self._events_ready = Condition()
+        self.last_event_time = 0.0
+        # Direction of each axis as last forwarded by the input thread
+        self._axis_directions: Dict[int, Optional[str]] = {}
+
         # Track the state of all keys
         self._keys_pressed: set[str] = set()
         self._keys_held: set[str] = set()
@@ -120,16 +129,98 @@ class Input:
             self._keys_held.add(key_name)
             self._keys_held_start_time[key_name] = time.time()
 
-    def _remove_key_held(self, key_name: str) -> None:
-        """Remove a key from the pressed set"""
+    def _remove_key_held(self, key_name: str) -> bool:
+        """Remove a key from the pressed set, returning whether it was held"""
         with self._input_lock:
-            self._keys_held.discard(key_name)
             self._keys_held_start_time.pop(key_name, None)
+            if key_name not in self._keys_held:
+                return False
+            self._keys_held.discard(key_name)
+            return True
+
+    def _is_noise(self, event: sdl2.SDL_Event) -> bool:
+        """
+        Return whether an event can't change the key states, such as analog
+        stick drift, so it doesn't wake an idle main loop.
+        """
+        if event.type in (
+            sdl2.SDL_JOYAXISMOTION,
+            sdl2.SDL_JOYBALLMOTION,
+            sdl2.SDL_JOYHATMOTION,
+            sdl2.SDL_SENSORUPDATE,
+            sdl2.SDL_CONTROLLERSENSORUPDATE,
+        ):
+            return True
+        if event.type != sdl2.SDL_CONTROLLERAXISMOTION:
+            return False
+
+        # Same thresholds as check_event
+        axis, value = event.caxis.axis, event.caxis.value
+        if axis not in self._axis_mapping:
+            return True
+        if abs(value) > 10000:
+            self._axis_directions[axis] = "+" if value > 0 else "-"
+            return False
+        if abs(value) < 5000 and self._axis_directions.get(axis):
+            self._axis_directions[axis] = None
+            return False
+        return True
+
+    def wait_events(self, timeout_ms: int = 100) -> None:
+        """
+        Block until SDL events arrive or the timeout expires, then queue them.
+        Meant to run on the input thread, without spinning the CPU.
+        """
+        event = sdl2.SDL_Event()
+        if not sdl2.SDL_WaitEventTimeout(ctypes.byref(event), timeout_ms):
+            return
+
+        events = [event]
+        while True:
+            event = sdl2.SDL_Event()
+            if not sdl2.SDL_PollEvent(ctypes.byref(event)):
+                break
+            events.append(event)
+
+        events = [event for event in events if not self._is_noise(event)]
+        if not events:
+            return
+        with self._events_ready:
+            self._events.extend(events)
+            self._events_ready.notify_all()
+
+    def process_events(self) -> list[sdl2.SDL_Event]:
+        """
+        Apply the queued events to the key states and return them.
+        Called once per frame so presses can't be cleared before they are read.
+        """
+        with self._events_ready:
+            events = list(self._events)
+            self._events.clear()
+
+        changed = False
+        for event in events:
+            changed = self.check_event(event) or changed
+        # Window events and stick drift don't keep the full frame rate
+        if changed:
+            self.last_event_time = time.time()
+        return events
+
+    def wait_for_events(self, timeout: float) -> bool:
+        """Block the caller until events are queued or the timeout expires."""
+        with self._events_ready:
+            if not self._events:
+                self._events_ready.wait(timeout)
+            return bool(self._events)
+
+    def has_held_keys(self) -> bool:
+        with self._input_lock:
+            return bool(self._keys_held)
 
     def check_event(self, event=None) -> bool:
         """
         Check for input events and update key states
-        Returns if an event was processed
+        Returns if the key states changed
         """
         if event:
             # Controller button press
@@ -148,7 +239,7 @@ class Input:
                 # Clear the key if it was pressed
                 if button in self._key_mapping:
                     key_name = self._key_mapping[button]
-                    self._remove_key_held(key_name)
+                    return self._remove_key_held(key_name)
 
             # Controller axis motion
             elif event.type == sdl2.SDL_CONTROLLERAXISMOTION:
@@ -166,8 +257,9 @@ class Input:
 
                     # Reset when axis returns to center
                     elif abs(value) < 5000:
-                        self._remove_key_held(f"{key_name}+")
-                        self._remove_key_held(f"{key_name}-")
+                        released_plus = self._remove_key_held(f"{key_name}+")
+                        released_minus = self._remove_key_held(f"{key_name}-")
+                        return released_plus or released_minus
 
         return False
 
@@ -0,0 +1,93 @@
+import json
+import os
+import threading
+from typing import Optional, TextIO
+
+from models import Rom
+
+
+class DownloadJournal:
+    """
+    On-disk record of the download queue, so a batch interrupted by a
+    crash, an exit or an empty battery can be resumed on the next start.
+    A batch is written once when it starts, then every ROM that starts,
+    completes or fails appends one line, which costs a small write per ROM.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._lock = threading.Lock()
+        self._file: Optional[TextIO] = None
+
+    def _append(self, record: dict) -> None:
+        with self._lock:
+            if self._file is None:
+                return
+            self._file.write(json.dumps(record) + "\n")
+            self._file.flush()
+            # The point is surviving a power loss
+            os.fsync(self._file.fileno())
+
+    def start_batch(self, roms: list[Rom]) -> None:
+        """Replace the journal with a new batch of queued ROMs."""
+        tmp_path = f"{self.path}.tmp"
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+            with open(tmp_path, "w") as f:
+                for rom in roms:
+                    f.write(json.dumps({"op": "queued", "rom": rom._asdict()}) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+            self._file = open(self.path, "a")
+
+    def started(self, rom: Rom) -> None:
+        self._append({"op": "started", "id": rom.id})
+
+    def completed(self, rom: Rom) -> None:
+        self._append({"op": "completed", "id": rom.id})
+
+    def failed(self, rom: Rom) -> None:
+        self._append({"op": "failed", "id": rom.id})
+
+    def clear(self) -> None:
+        """Forget the batch, once it's done or the user aborted it."""
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            if os.path.exists(self.path):
+                os.remove(self.path)
+
+    def pending(self) -> list[Rom]:
+        """
+        Return the ROMs of the journaled batch that didn't complete, in
+        queue order. ROMs that were in progress resume from their part file.
+        """
+        if not os.path.exists(self.path):
+            return []
+
+        queued: dict[int, Rom] = {}
+        finished: set[int] = set()
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # The last line may be cut short by a power loss
+                    continue
+                if record.get("op") == "queued":
+                    fields = record["rom"]
+                    fields["fs_size"] = tuple(fields["fs_size"])
+                    rom = Rom(**{k: v for k, v in fields.items() if k in Rom._fields})
+                    queued[rom.id] = rom
+                elif record.get("op") in ("completed", "failed"):
+                    finished.add(record["id"])
+        return [rom for rom_id, rom in queued.items() if rom_id not in finished]
+
+    def close(self) -> None:
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
@@ -14,6 +14,7 @@ from config import set_controller_layout
 from dotenv import load_dotenv
 from platform_maps import init_env_maps
 from romm import RomM
+from scheduler import FrameScheduler
 
 
 def apply_pending_update():
@@ -56,6 +57,7 @@ if not apply_pending_update():
 
 
 def cleanup(romm: RomM, exit_code: int):
+    romm.api.cleanup()
     romm.ui.cleanup()
     romm.input.cleanup()
 
@@ -71,6 +73,7 @@ def main():
 
     romm = RomM()
     romm.start()
+    scheduler = FrameScheduler(romm.input, romm.status, romm.ui)
 
     try:
         while romm.running:
@@ -79,8 +82,8 @@ def main():
             romm.ui.render_to_screen()  # Render to the screen
             romm.input.clear_pressed()  # Clear pressed keys
 
-            # Add a small sleep to prevent 100% CPU usage
-            sdl2.SDL_Delay(16)
+            # Sleep until the next frame, longer while nothing is happening
+            scheduler.wait()
     except RuntimeError:
         cleanup(romm, 1)
 
@@ -15,7 +15,17 @@ Rom = namedtuple(
         "regions",
         "revision",
         "tags",
+        "crc_hash",
+        "md5_hash",
+        "sha1_hash",
+        # Sum of the sizes of the files of a multi-file ROM, once extracted
+        "files_size_bytes",
     ],
+    defaults=(None, None, None, None),
 )
 Collection = namedtuple("Collection", ["id", "name", "rom_count", "virtual"])
 Platform = namedtuple("Platform", ["id", "display_name", "slug", "rom_count"])
+StorageUsage = namedtuple("StorageUsage", ["total", "used", "free"])
+DownloadProgress = namedtuple(
+    "DownloadProgress", ["rom", "downloaded_bytes", "percent", "extracting"]
+)
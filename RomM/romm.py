@@ -4,7 +4,6 @@ import time
 from typing import Any, Dict, List, Tuple
 
 import sdl2
-import sdl2.ext
 from models import Rom
 
 if os.path.exists(os.path.join(os.path.dirname(__file__), "__version__.py")):
@@ -22,7 +21,7 @@ from config import (
 from filesystem import Filesystem
 from glyps import glyphs
 from input import Input
-from status import Filter, Status, View
+from status import Status, View
 from ui import (
     UserInterface,
     color_menu_bg,
@@ -68,6 +67,9 @@ class RomM:
         self.last_spinner_update = time.time()
         self.current_spinner_status = next(glyphs.spinner)
 
+        # Downloads of an interrupted batch, offered to resume on start
+        self.pending_downloads: list[Rom] = []
+
         # Set update variables
         self.awaiting_input = False
         self.latest_version = None
@@ -187,6 +189,111 @@ class RomM:
                 self.status.updating.clear()
                 self.ui.draw_clear()
 
+    def _handle_resume_confirmation(self):
+        self.ui.draw_text(
+            (self.ui.screen_width / 2, self.ui.screen_height / 2 - 20),
+            f"{len(self.pending_downloads)} downloads were interrupted",
+            color=color_text,
+            anchor="mm",
+        )
+        self.ui.draw_text(
+            (self.ui.screen_width / 2, self.ui.screen_height / 2 + 20),
+            "Resume downloads?",
+            color=color_text,
+            anchor="mm",
+        )
+        self.buttons_config = [
+            {
+                "key": self.controller_layout["a"]["btn"],
+                "label": "Yes",
+                "color": self.controller_layout["a"]["color"],
+            },
+            {
+                "key": self.controller_layout["b"]["btn"],
+                "label": "No",
+                "color": self.controller_layout["b"]["color"],
+            },
+        ]
+        self.draw_buttons()
+
+        if self.input.key(self.controller_layout["a"]["key"]):
+            roms, self.pending_downloads = self.pending_downloads, []
+            self._start_downloads(roms)
+        elif self.input.key(self.controller_layout["b"]["key"]):
+            self.pending_downloads = []
+            self.api.journal.clear()
+
+    def _start_downloads(self, roms: list[Rom]) -> None:
+        if self.fs.plan_placement(roms) is None:
+            self.status.show_notice(
+                "Error: Not enough free space on SD card"
+                if len(self.fs.get_sd_cards()) == 1
+                else "Error: Not enough free space on SD cards"
+            )
+            return
+        self.status.download_rom_ready.clear()
+        self.status.multi_selected_roms = roms
+        self.status.download_queue = self.status.multi_selected_roms
+        self.status.abort_download.clear()
+        threading.Thread(target=self.api.download_rom).start()
+
+    def _render_downloads(self):
+        active = self.status.get_active_downloads()
+        if not active:
+            return
+        position = (
+            f"{self.status.downloading_rom_position}/{len(self.status.download_queue)}"
+        )
+        if self.status.download_speed:
+            position += f" | {self.status.download_speed / 1024**2:.1f} MB/s"
+        eta = self.status.download_eta()
+        if eta is not None and len(self.status.download_queue) > 1:
+            minutes, seconds = divmod(int(eta), 60)
+            hours, minutes = divmod(minutes, 60)
+            position += (
+                f" | ETA {hours}:{minutes:02}:{seconds:02}"
+                if hours
+                else f" | ETA {minutes}:{seconds:02}"
+            )
+
+        if len(active) == 1:
+            progress = active[0]
+            if progress.extracting:
+                self.ui.draw_loader(
+                    progress.percent,
+                    color=self.controller_layout["b"]["color"],
+                )
+                text_line_1 = f"{position} | {progress.percent:.2f}% | Extracting {progress.rom.name}"
+            else:
+                self.ui.draw_loader(progress.percent)
+                text_line_1 = f"{position} | {progress.percent:.2f}% | {glyphs.download} {progress.rom.name}"
+            self.ui.draw_log(
+                text_line_1=text_line_1,
+                # Stalls and retries show up in place of the file name
+                text_line_2=(
+                    self.status.notice
+                    if self.status.has_notice()
+                    else f"({progress.rom.fs_name})"
+                ),
+                background=False,
+            )
+            return
+
+        # Several transfers in flight, show the batch progress and each ROM
+        self.ui.draw_loader(self.status.downloaded_percent)
+        self.ui.draw_log(
+            text_line_1=f"{position} | {self.status.downloaded_percent:.2f}% | {glyphs.download} {len(active)} downloads",
+            text_line_2=(
+                self.status.notice
+                if self.status.has_notice()
+                else " | ".join(
+                    f"{p.rom.name} {'Extracting ' if p.extracting else ''}{p.percent:.0f}%"
+                    for p in active
+                )
+            ),
+            background=False,
+        )
+
     def _render_platforms_view(self):
         if self.status.updating.is_set():
             return
@@ -202,27 +309,17 @@ class RomM:
             if current_time - self.last_spinner_update >= self.spinner_speed:
                 self.last_spinner_update = current_time
                 self.current_spinner_status = next(glyphs.spinner)
+            self.ui.animating = True
             self.ui.draw_log(
                 text_line_1=f"{self.current_spinner_status} Fetching platforms"
             )
         elif not self.status.download_rom_ready.is_set():
-            if self.status.extracting_rom and self.status.downloading_rom:
-                self.ui.draw_loader(
-                    self.status.extracted_percent,
-                    color=self.controller_layout["b"]["color"],
-                )
-                self.ui.draw_log(
-                    text_line_1=f"{self.status.downloading_rom_position}/{len(self.status.download_queue)} | {self.status.extracted_percent:.2f}% | Extracting {self.status.downloading_rom.name}",
-                    text_line_2=f"({self.status.downloading_rom.fs_name})",
-                    background=False,
-                )
-            elif self.status.downloading_rom:
-                self.ui.draw_loader(self.status.downloaded_percent)
-                self.ui.draw_log(
-                    text_line_1=f"{self.status.downloading_rom_position}/{len(self.status.download_queue)} | {self.status.downloaded_percent:.2f}% | {glyphs.download} {self.status.downloading_rom.name}",
-                    text_line_2=f"({self.status.downloading_rom.fs_name})",
-                    background=False,
-                )
+            self._render_downloads()
+        elif self.status.has_notice():
+            self.ui.draw_log(
+                text_line_1=self.status.notice,
+                text_color=self.controller_layout["a"]["color"],
+            )
         elif not self.status.valid_host:
             self.ui.draw_log(
                 text_line_1=f"Error: Can't connect to host {self.api.host}",
@@ -256,6 +353,10 @@ class RomM:
             self.draw_buttons()
 
     def _update_platforms_view(self):
+        # A revalidated list may be shorter than the cached one
+        self.platforms_selected_position = min(
+            self.platforms_selected_position, max(len(self.status.platforms) - 1, 0)
+        )
         if self.input.key(self.controller_layout["a"]["key"]):
             if self.status.roms_ready.is_set() and len(self.status.platforms) > 0:
                 self.status.roms_ready.clear()
@@ -309,27 +410,17 @@ class RomM:
             if current_time - self.last_spinner_update >= self.spinner_speed:
                 self.last_spinner_update = current_time
                 self.current_spinner_status = next(glyphs.spinner)
+            self.ui.animating = True
             self.ui.draw_log(
                 text_line_1=f"{self.current_spinner_status} Fetching collections"
             )
         elif not self.status.download_rom_ready.is_set():
-            if self.status.extracting_rom and self.status.downloading_rom:
-                self.ui.draw_loader(
-                    self.status.extracted_percent,
-                    color=self.controller_layout["b"]["color"],
-                )
-                self.ui.draw_log(
-                    text_line_1=f"{self.status.downloading_rom_position}/{len(self.status.download_queue)} | {self.status.extracted_percent:.2f}% | Extracting {self.status.downloading_rom.name}",
-                    text_line_2=f"({self.status.downloading_rom.fs_name})",
-                    background=False,
-                )
-            elif self.status.downloading_rom:
-                self.ui.draw_loader(self.status.downloaded_percent)
-                self.ui.draw_log(
-                    text_line_1=f"{self.status.downloading_rom_position}/{len(self.status.download_queue)} | {self.status.downloaded_percent:.2f}% | {glyphs.download} {self.status.downloading_rom.name}",
-                    text_line_2=f"({self.status.downloading_rom.fs_name})",
-                    background=False,
-                )
+            self._render_downloads()
+        elif self.status.has_notice():
+            self.ui.draw_log(
+                text_line_1=self.status.notice,
+                text_color=self.controller_layout["a"]["color"],
+            )
         elif not self.status.valid_host:
             self.ui.draw_log(
                 text_line_1=f"Error: Can't connect to host {self.api.host}",
@@ -363,6 +454,10 @@ class RomM:
             self.draw_buttons()
 
     def _update_collections_view(self):
+        self.collections_selected_position = min(
+            self.collections_selected_position,
+            max(len(self.status.collections) - 1, 0),
+        )
         if self.input.key(self.controller_layout["a"]["key"]):
             if self.status.roms_ready.is_set() and len(self.status.collections) > 0:
                 self.status.roms_ready.clear()
@@ -433,21 +528,11 @@ class RomM:
 
         if len(self.status.multi_selected_roms) > 0:
             header_text += f" ({len(self.status.multi_selected_roms)} selected)"
-        if self.status.current_filter == Filter.ALL:
-            self.status.roms_to_show = self.status.roms
-        elif self.status.current_filter == Filter.LOCAL:
-            self.status.roms_to_show = [
-                r for r in self.status.roms if self.fs.is_rom_in_device(r)
-            ]
-        elif self.status.current_filter == Filter.REMOTE:
-            self.status.roms_to_show = [
-                r for r in self.status.roms if not self.fs.is_rom_in_device(r)
-            ]
 
         self.ui.draw_roms_list(
             self.roms_selected_position,
             self.max_n_roms,
-            self.status.roms_to_show,
+            self.status.get_roms_page(self.roms_selected_position, self.max_n_roms),
             header_text,
             header_color,
             self.status.multi_selected_roms,
@@ -459,25 +544,15 @@ class RomM:
             if current_time - self.last_spinner_update >= self.spinner_speed:
                 self.last_spinner_update = current_time
                 self.current_spinner_status = next(glyphs.spinner)
+            self.ui.animating = True
             self.ui.draw_log(text_line_1=f"{self.current_spinner_status} Fetching roms")
         elif not self.status.download_rom_ready.is_set():
-            if self.status.extracting_rom and self.status.downloading_rom:
-                self.ui.draw_loader(
-                    self.status.extracted_percent,
-                    color=self.controller_layout["b"]["color"],
-                )
-                self.ui.draw_log(
-                    text_line_1=f"{self.status.downloading_rom_position}/{len(self.status.download_queue)} | {self.status.extracted_percent:.2f}% | Extracting {self.status.downloading_rom.name}",
-                    text_line_2=f"({self.status.downloading_rom.fs_name})",
-                    background=False,
-                )
-            elif self.status.downloading_rom:
-                self.ui.draw_loader(self.status.downloaded_percent)
-                self.ui.draw_log(
-                    text_line_1=f"{self.status.downloading_rom_position}/{len(self.status.download_queue)} | {self.status.downloaded_percent:.2f}% | {glyphs.download} {self.status.downloading_rom.name}",
-                    text_line_2=f"({self.status.downloading_rom.fs_name})",
-                    background=False,
-                )
+            self._render_downloads()
+        elif self.status.has_notice():
+            self.ui.draw_log(
+                text_line_1=self.status.notice,
+                text_color=self.controller_layout["a"]["color"],
+            )
         elif not self.status.valid_host:
             self.ui.draw_log(
                 text_line_1=f"Error: Can't connect to host {self.api.host}",
@@ -539,20 +614,19 @@ class RomM:
             self.draw_buttons()
 
     def _update_roms_view(self):
+        self.roms_selected_position = min(
+            self.roms_selected_position, max(len(self.status.roms_to_show) - 1, 0)
+        )
         if self.input.key(self.controller_layout["a"]["key"]):
             if (
                 self.status.roms_ready.is_set()
                 and self.status.download_rom_ready.is_set()
                 and len(self.status.roms_to_show) > 0
             ):
-                self.status.download_rom_ready.clear()
-                if len(self.status.multi_selected_roms) == 0:
-                    self.status.multi_selected_roms.append(
-                        self.status.roms_to_show[self.roms_selected_position]
-                    )
-                self.status.download_queue = self.status.multi_selected_roms
-                self.status.abort_download.clear()
-                threading.Thread(target=self.api.download_rom).start()
+                self._start_downloads(
+                    self.status.multi_selected_roms
+                    or [self.status.roms_to_show[self.roms_selected_position]]
+                )
         elif self.input.key(self.controller_layout["b"]["key"]):
             if self.status.selected_platform:
                 self.status.current_view = View.PLATFORMS
@@ -726,6 +800,8 @@ class RomM:
             selected_pos = self.start_menu_selected_position
             if selected_pos == self.start_menu_options[0][1]:
                 self.status.abort_download.set()
+                # Aborted on purpose, don't offer to resume it
+                self.api.journal.clear()
                 self.status.show_start_menu = False
             elif selected_pos == self.start_menu_options[1][1]:
                 self.fs.switch_sd_storage()
@@ -772,21 +848,30 @@ class RomM:
 
     def _monitor_input(self):
         while self.running:
-            events = sdl2.ext.get_events()
-            for event in events:
-                self.input.check_event(event)
-                if event.type == sdl2.SDL_QUIT:
-                    self.running = False
+            self.input.wait_events()
+
+    def _process_events(self):
+        for event in self.input.process_events():
+            if event.type == sdl2.SDL_QUIT:
+                self.running = False
+            elif event.type == sdl2.SDL_WINDOWEVENT:
+                if event.window.event == sdl2.SDL_WINDOWEVENT_SIZE_CHANGED:
+                    self.ui.invalidate_window_size()
+                elif event.window.event == sdl2.SDL_WINDOWEVENT_EXPOSED:
+                    self.ui.force_redraw()
 
     def start(self):
+        self.pending_downloads = self.api.journal.pending()
         self._render_platforms_view()
         threading.Thread(target=self._monitor_input, daemon=True).start()
+        self.fs.start_storage_monitor()
         threading.Thread(target=self._check_for_updates).start()
         threading.Thread(target=self.api.fetch_platforms).start()
         threading.Thread(target=self.api.fetch_collections).start()
         threading.Thread(target=self.api.fetch_me).start()
 
     def update(self):
+        self._process_events()
         self.ui.draw_clear()
 
         if self.awaiting_input:
@@ -796,6 +881,10 @@ class RomM:
         if self.status.updating.is_set():
             return
 
+        if self.pending_downloads:
+            self._handle_resume_confirmation()
+            return
+
         if self.status.me_ready.is_set():
             self.ui.draw_header(self.api.host, self.api.username)
 
@@ -895,3 +984,6 @@ class RomM:
                 [storage_path, full_path]
             ) == storage_path and os.path.isfile(full_path):
                 os.remove(full_path)
+
+        self.fs.mark_rom_removed(rom)
+        self.fs.refresh_storage_usage()
@@ -0,0 +1,86 @@
+import os
+import time
+
+import sdl2
+from bandwidth import BandwidthManager
+from input import Input
+from status import Status
+from ui import UserInterface
+
+
+class FrameScheduler:
+    """
+    Paces the main loop: full frame rate while something on screen is moving
+    or the user is interacting, a low idle rate otherwise.
+    """
+
+    active_frame_ms = 16
+
+    def __init__(self, input: Input, status: Status, ui: UserInterface) -> None:
+        self.input = input
+        self.status = status
+        self.ui = ui
+        self.bandwidth = BandwidthManager()
+
+        # Idle frames only pick up background changes, input wakes the loop
+        self.idle_frame_time = float(os.getenv("IDLE_FRAME_MS", "250")) / 1000
+        # Keep the full rate for a while after the last input
+        self.idle_delay = float(os.getenv("IDLE_DELAY", "2"))
+        self.stats_interval = float(os.getenv("FRAME_STATS_INTERVAL", "60"))
+
+        self.idle = False
+        self.fps = 0.0
+        self.cpu_ms_per_frame = 0.0
+
+        self._stats_start = time.time()
+        self._stats_start_cpu = time.process_time()
+        self._stats_frames = 0
+
+    def is_browsing(self) -> bool:
+        """Return whether the user is navigating the UI."""
+        return (
+            time.time() - self.input.last_event_time < self.idle_delay
+            or self.input.has_held_keys()
+        )
+
+    def is_active(self) -> bool:
+        """Return whether the next frame has to be drawn at the full rate."""
+        return (
+            self.is_browsing()
+            # Spinners and scrolling text
+            or self.ui.animating
+            # Active transfers
+            or not self.status.download_rom_ready.is_set()
+            or self.status.updating.is_set()
+        )
+
+    def _report(self) -> None:
+        now = time.time()
+        elapsed = now - self._stats_start
+        if elapsed < self.stats_interval or self._stats_frames == 0:
+            return
+
+        cpu_time = time.process_time() - self._stats_start_cpu
+        self.fps = self._stats_frames / elapsed
+        self.cpu_ms_per_frame = cpu_time / self._stats_frames * 1000
+        print(
+            f"Frames: {self.fps:.1f} fps, {self.cpu_ms_per_frame:.2f} ms CPU/frame, "
+            f"{'idle' if self.idle else 'active'}"
+        )
+        self._stats_start = now
+        self._stats_start_cpu = time.process_time()
+        self._stats_frames = 0
+
+    def wait(self) -> None:
+        """Sleep until the next frame is due."""
+        self._stats_frames += 1
+        self._report()
+        if self.is_browsing():
+            # Leave the link to the requests the UI is waiting on
+            self.bandwidth.note_browsing()
+
+        self.idle = not self.is_active()
+        if self.idle:
+            self.input.wait_for_events(self.idle_frame_time)
+        else:
+            sdl2.SDL_Delay(self.active_frame_ms)
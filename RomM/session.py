@@ -0,0 +1,349 @@
+import io
+import socket
+import ssl
+import threading
+import time
+from http.client import HTTPConnection, HTTPException, HTTPResponse, HTTPSConnection
+from typing import Optional
+from urllib.error import HTTPError, URLError
+from urllib.parse import urljoin, urlsplit
+
+from bandwidth import BandwidthManager, Priority
+
+# Errors raised when the server already dropped an idle keep-alive connection
+_STALE_CONNECTION_ERRORS = (ConnectionResetError, BrokenPipeError, HTTPException)
+
+
+class TransferStalled(URLError):
+    """No data arrived for longer than the read timeout."""
+
+
+class Response:
+    """
+    Body of a pooled request. The connection goes back to the pool once the
+    body is read to the end, and is dropped if the response is closed early.
+    """
+
+    def __init__(
+        self,
+        session: "Session",
+        key: tuple[str, str, int],
+        conn: HTTPConnection,
+        response: HTTPResponse,
+        url: str,
+        priority: str,
+    ) -> None:
+        self._session = session
+        self._priority = priority
+        self._key = key
+        self._conn: Optional[HTTPConnection] = conn
+        self._response = response
+        self.url = url
+        self.status = response.status
+        self.reason = response.reason
+        self.headers = response.headers
+        self.bytes_read = 0
+        self.aborted = False
+        # Set while the read waits on the bulk bandwidth limit
+        self.throttled = False
+
+    def _read_error(self, error: Exception) -> URLError:
+        self.close()
+        if self.aborted or isinstance(error, TimeoutError):
+            return TransferStalled(error)
+        return URLError(error)
+
+    def _check_aborted(self) -> None:
+        # A shut down socket reads as the end of a body of unknown length
+        if self.aborted:
+            raise self._read_error(TimeoutError("Transfer aborted"))
+
+    def read(self, amt: Optional[int] = None) -> bytes:
+        try:
+            data = self._response.read(amt)
+        except (OSError, HTTPException) as e:
+            raise self._read_error(e) from e
+        self._check_aborted()
+        self.bytes_read += len(data)
+        self._consume(len(data))
+        if amt is None or not data:
+            self._release()
+        return data
+
+    def readinto(self, buffer) -> int:
+        try:
+            n = self._response.readinto(buffer)
+        except (OSError, HTTPException) as e:
+            raise self._read_error(e) from e
+        self._check_aborted()
+        self.bytes_read += n
+        self._consume(n)
+        if not n:
+            self._release()
+        return n
+
+    def _consume(self, n: int) -> None:
+        self.throttled = True
+        try:
+            self._session.bandwidth.consume(n, self._priority)
+        finally:
+            self.throttled = False
+
+    def _release(self) -> None:
+        conn, self._conn = self._conn, None
+        if conn is None:
+            return
+        if (
+            self._response.isclosed()
+            and not self._response.will_close
+            and not self.aborted
+        ):
+            self._session._put_connection(self._key, conn)
+        else:
+            conn.close()
+
+    def abort(self) -> None:
+        """
+        Make a read blocked in another thread fail with TransferStalled, for
+        connections that stopped sending without being closed.
+        """
+        self.aborted = True
+        conn = self._conn
+        if conn is not None and conn.sock is not None:
+            try:
+                conn.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def close(self) -> None:
+        self._release()
+        self._response.close()
+
+    def __enter__(self) -> "Response":
+        return self
+
+    def __exit__(self, *_exc) -> None:
+        self.close()
+
+
+class Session:
+    """
+    Minimal HTTP client keeping persistent connections per host.
+    Reuses one TLS context, caches DNS lookups and sends the default headers
+    (such as the auth header) with every request. Errors are raised as the
+    urllib ones (HTTPError, URLError, ValueError) so callers can handle them
+    the same way as with urlopen. Reads are accounted to the shared
+    BandwidthManager with the priority of the request.
+    """
+
+    max_idle_per_host = 4
+    max_redirects = 5
+    dns_ttl = 300
+
+    def __init__(self, headers: Optional[dict[str, str]] = None) -> None:
+        self.headers = dict(headers or {})
+        self.bandwidth = BandwidthManager()
+        self._ssl_context = ssl.create_default_context()
+        self._lock = threading.Lock()
+        self._idle: dict[tuple[str, str, int], list[HTTPConnection]] = {}
+        # (host, port) -> (expiry time, resolved addresses)
+        self._dns_cache: dict[tuple[str, int], tuple[float, list]] = {}
+
+        self.requests = 0
+        self.connections_opened = 0
+        self.connections_reused = 0
+        self.dns_lookups = 0
+
+    def _resolve(self, host: str, port: int) -> list:
+        now = time.monotonic()
+        with self._lock:
+            cached = self._dns_cache.get((host, port))
+        if cached is not None and cached[0] > now:
+            return cached[1]
+
+        self.dns_lookups += 1
+        addresses = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+        with self._lock:
+            self._dns_cache[(host, port)] = (now + self.dns_ttl, addresses)
+        return addresses
+
+    def _create_connection(self, address, timeout=None, source_address=None):
+        host, port = address
+        last_error: Optional[OSError] = None
+        for family, type, proto, _name, sockaddr in self._resolve(host, port):
+            sock = socket.socket(family, type, proto)
+            try:
+                sock.settimeout(timeout)
+                if source_address:
+                    sock.bind(source_address)
+                sock.connect(sockaddr)
+                return sock
+            except OSError as e:
+                sock.close()
+                last_error = e
+
+        # The cached addresses may be stale, look them up again next time
+        with self._lock:
+            self._dns_cache.pop((host, port), None)
+        raise last_error or OSError(f"Could not resolve {host}")
+
+    def _new_connection(
+        self, key: tuple[str, str, int], timeout: Optional[float]
+    ) -> HTTPConnection:
+        scheme, host, port = key
+        conn: HTTPConnection
+        if scheme == "https":
+            conn = HTTPSConnection(
+                host, port, timeout=timeout, context=self._ssl_context
+            )
+        else:
+            conn = HTTPConnection(host, port, timeout=timeout)
+        conn._create_connection = self._create_connection  # type: ignore[attr-defined]
+        self.connections_opened += 1
+        return conn
+
+    def _get_connection(
+        self, key: tuple[str, str, int], timeout: Optional[float]
+    ) -> tuple[HTTPConnection, bool]:
+        with self._lock:
+            idle = self._idle.get(key)
+            conn = idle.pop() if idle else None
+        if conn is None:
+            return self._new_connection(key, timeout), False
+
+        conn.timeout = timeout
+        if conn.sock is not None:
+            conn.sock.settimeout(timeout)
+        self.connections_reused += 1
+        return conn, True
+
+    def _put_connection(self, key: tuple[str, str, int], conn: HTTPConnection) -> None:
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.max_idle_per_host:
+                idle.append(conn)
+                return
+        conn.close()
+
+    @staticmethod
+    def _origin(url: str) -> tuple[str, Optional[str], int]:
+        parts = urlsplit(url)
+        default_port = 443 if parts.scheme == "https" else 80
+        return parts.scheme, parts.hostname, parts.port or default_port
+
+    def _send(
+        self,
+        method: str,
+        url: str,
+        headers: dict[str, str],
+        timeout: Optional[float],
+        priority: str,
+    ) -> Response:
+        parts = urlsplit(url)
+        if parts.scheme not in ("http", "https") or not parts.hostname:
+            raise ValueError(f"unknown url type: {url!r}")
+
+        default_port = 443 if parts.scheme == "https" else 80
+        key = (parts.scheme, parts.hostname, parts.port or default_port)
+        path = parts.path or "/"
+        if parts.query:
+            path += f"?{parts.query}"
+
+        self.requests += 1
+        conn, reused = self._get_connection(key, timeout)
+        try:
+            try:
+                conn.request(method, path, headers=headers)
+                response = conn.getresponse()
+            except _STALE_CONNECTION_ERRORS:
+                if not reused:
+                    raise
+                # Retry once on a fresh connection
+                self.connections_reused -= 1
+                conn.close()
+                conn = self._new_connection(key, timeout)
+                conn.request(method, path, headers=headers)
+                response = conn.getresponse()
+        except (OSError, HTTPException) as e:
+            conn.close()
+            raise URLError(e) from e
+
+        return Response(self, key, conn, response, url, priority)
+
+    def request(
+        self,
+        method: str,
+        url: str,
+        headers: Optional[dict[str, str]] = None,
+        timeout: Optional[float] = 60,
+        priority: str = Priority.INTERACTIVE,
+    ) -> Response:
+        """
+        Send a request and return the response once its headers are received.
+        Redirects are followed, without the Authorization header once they
+        leave the origin. 4xx and 5xx statuses raise HTTPError.
+        """
+        request_headers = {**self.headers, **(headers or {})}
+        if priority == Priority.INTERACTIVE:
+            # Make bulk transfers yield while waiting for the server
+            self.bandwidth.note_interactive()
+
+        for _ in range(self.max_redirects + 1):
+            response = self._send(method, url, request_headers, timeout, priority)
+            location = response.headers.get("Location")
+            if response.status in (301, 302, 303, 307, 308) and location:
+                response.read()
+                redirect_url = urljoin(url, location)
+                if self._origin(redirect_url) != self._origin(url):
+                    # Don't send the credentials to another host
+                    request_headers = {
+                        name: value
+                        for name, value in request_headers.items()
+                        if name.lower() != "authorization"
+                    }
+                url = redirect_url
+                if response.status == 303:
+                    method = "GET"
+                continue
+
+            if response.status >= 400:
+                body = response.read()
+                raise HTTPError(
+                    url,
+                    response.status,
+                    response.reason,
+                    response.headers,
+                    io.BytesIO(body),
+                )
+            return response
+
+        raise URLError(f"Too many redirects for {url}")
+
+    def get(
+        self,
+        url: str,
+        headers: Optional[dict[str, str]] = None,
+        timeout: Optional[float] = 60,
+        priority: str = Priority.INTERACTIVE,
+    ) -> Response:
+        return self.request(
+            "GET", url, headers=headers, timeout=timeout, priority=priority
+        )
+
+    def stats(self) -> str:
+        reuse_rate = (
+            self.connections_reused / self.requests * 100 if self.requests else 0.0
+        )
+        return (
+            f"{self.requests} requests, {self.connections_opened} connections opened, "
+            f"{self.connections_reused} reused ({reuse_rate:.1f}% reuse), "
+            f"{self.dns_lookups} DNS lookups"
+        )
+
+    def close(self) -> None:
+        """Close all idle connections."""
+        with self._lock:
+            idle = [conn for conns in self._idle.values() for conn in conns]
+            self._idle.clear()
+        for conn in idle:
+            conn.close()
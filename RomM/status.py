@@ -1,8 +1,10 @@
 import itertools
 import threading
+import time
 from typing import Optional
 
-from models import Collection, Platform, Rom
+from filesystem import Filesystem
+from models import Collection, DownloadProgress, Platform, Rom
 
 
 class View:
@@ -43,8 +45,12 @@ class Status:
 
         self.platforms: list[Platform] = []
         self.collections: list[Collection] = []
+        self._fs = Filesystem()
+        self._roms_version = 0
         self.roms: list[Rom] = []
-        self.roms_to_show: list[Rom] = []
+        # Filtered ROMs and the state of the inputs they were computed from
+        self._roms_to_show: list[Rom] = []
+        self._roms_to_show_version: Optional[tuple] = None
         self.filters = itertools.cycle([Filter.ALL, Filter.LOCAL, Filter.REMOTE])
         self.current_filter = next(self.filters)
 
@@ -69,6 +75,150 @@ class Status:
         self.downloaded_percent = 0.0
         self.extracting_rom = False
         self.extracted_percent = 0.0
+        # Transfers in flight keyed by ROM id, and the totals of the batch
+        self.active_downloads: dict[int, DownloadProgress] = {}
+        self.completed_downloads = 0
+        # ROMs of the batch that failed, with what went wrong
+        self.failed_downloads: list[tuple[Rom, str]] = []
+        # Bytes per second of the transfers in flight
+        self.download_speed = 0.0
+        self._completed_bytes = 0
+        self._queued_bytes = 0
+        self._batch_start = 0.0
+        self._downloads_lock = threading.Lock()
+
+        # Transient message shown in the status bar
+        self.notice = ""
+        self.notice_until = 0.0
+
+    @property
+    def roms(self) -> list[Rom]:
+        return self._roms
+
+    @roms.setter
+    def roms(self, roms: list[Rom]) -> None:
+        self._roms = roms
+        self._roms_version += 1
+
+    @property
+    def roms_to_show(self) -> list[Rom]:
+        """
+        ROMs matching the current filter.
+        Recomputed only when the ROM list, the filter, the SD card or the
+        local files changed.
+        """
+        version = (
+            self._roms_version,
+            self.current_filter,
+            self._fs.get_roms_storage_path(),
+            self._fs.presence_version,
+        )
+        if version == self._roms_to_show_version:
+            return self._roms_to_show
+
+        if self.current_filter == Filter.LOCAL:
+            self._roms_to_show = [r for r in self._roms if self._fs.is_rom_in_device(r)]
+        elif self.current_filter == Filter.REMOTE:
+            self._roms_to_show = [
+                r for r in self._roms if not self._fs.is_rom_in_device(r)
+            ]
+        else:
+            self._roms_to_show = self._roms
+        self._roms_to_show_version = version
+        return self._roms_to_show
+
+    def get_roms_page(self, selected_position: int, per_page: int) -> list[Rom]:
+        """Return the page of ROMs to show containing the selected position."""
+        start_idx = (selected_position // per_page) * per_page
+        return self.roms_to_show[start_idx : start_idx + per_page]
 
     def reset_roms_list(self) -> None:
         self.roms = []
+
+    def _update_download_totals(self) -> None:
+        # Aggregate fields read by the UI, the caller holds the lock
+        active = list(self.active_downloads.values())
+        self.total_downloaded_bytes = self._completed_bytes + sum(
+            p.downloaded_bytes for p in active
+        )
+        self.downloaded_percent = (
+            self.total_downloaded_bytes / (self._queued_bytes + 1) * 100
+        )
+        self.downloading_rom = active[0].rom if active else None
+        self.downloading_rom_position = self.completed_downloads + len(active)
+        extracting = [p for p in active if p.extracting]
+        self.extracting_rom = bool(extracting)
+        self.extracted_percent = extracting[0].percent if extracting else 0.0
+
+    def start_downloads(self, roms: list[Rom]) -> None:
+        with self._downloads_lock:
+            self.active_downloads.clear()
+            self.completed_downloads = 0
+            self.failed_downloads = []
+            self._completed_bytes = 0
+            self._queued_bytes = sum(rom.fs_size_bytes for rom in roms)
+            self._batch_start = time.time()
+            self._update_download_totals()
+
+    def set_download_progress(
+        self,
+        rom: Rom,
+        downloaded_bytes: int = 0,
+        extracted_percent: Optional[float] = None,
+    ) -> None:
+        """Record the progress of rom, extracted_percent is given while extracting."""
+        if extracted_percent is None:
+            # Add 1 virtual byte to avoid division by zero
+            percent = downloaded_bytes / (rom.fs_size_bytes + 1) * 100
+            progress = DownloadProgress(rom, downloaded_bytes, percent, False)
+        else:
+            progress = DownloadProgress(rom, rom.fs_size_bytes, extracted_percent, True)
+        with self._downloads_lock:
+            self.active_downloads[rom.id] = progress
+            self._update_download_totals()
+
+    def finish_download(self, rom: Rom) -> None:
+        with self._downloads_lock:
+            self.active_downloads.pop(rom.id, None)
+            self.completed_downloads += 1
+            self._completed_bytes += rom.fs_size_bytes
+            self._update_download_totals()
+
+    def fail_download(self, rom: Rom, reason: str) -> None:
+        """Count rom as done without it being on the device."""
+        with self._downloads_lock:
+            self.failed_downloads.append((rom, reason))
+        self.finish_download(rom)
+
+    def download_eta(self) -> Optional[float]:
+        """
+        Seconds left for the whole queue, from the rate of the transfers in
+        flight or the average of the batch so far between them.
+        """
+        elapsed = time.time() - self._batch_start
+        rate = self.download_speed or (
+            self.total_downloaded_bytes / elapsed if elapsed > 0 else 0.0
+        )
+        if rate <= 0:
+            return None
+        return max(0, self._queued_bytes - self.total_downloaded_bytes) / rate
+
+    def get_active_downloads(self) -> list[DownloadProgress]:
+        with self._downloads_lock:
+            return list(self.active_downloads.values())
+
+    def clear_download_progress(self) -> None:
+        with self._downloads_lock:
+            self.active_downloads.clear()
+            self.completed_downloads = 0
+            self.failed_downloads = []
+            self._completed_bytes = 0
+            self._queued_bytes = 0
+            self._update_download_totals()
+
+    def show_notice(self, text: str, duration: float = 3.0) -> None:
+        self.notice = text
+        self.notice_until = time.time() + duration
+
+    def has_notice(self) -> bool:
+        return bool(self.notice) and time.time() < self.notice_until
@@ -0,0 +1,345 @@
+import os
+import queue
+import threading
+import time
+from contextlib import nullcontext
+from typing import BinaryIO, Callable, Optional
+from urllib.error import HTTPError, URLError
+
+from bandwidth import Priority
+
+
+def preallocate(file: BinaryIO, size: int) -> None:
+    """
+    Reserve size bytes for file on disk so it is written to contiguous
+    blocks. The file has to be truncated to its real length once written.
+    """
+    if size <= 0 or not hasattr(os, "posix_fallocate"):
+        return
+    try:
+        os.posix_fallocate(file.fileno(), 0, size)
+    except OSError as e:
+        # Not supported by every filesystem, the copy works without it
+        print(f"Could not preallocate {size} bytes: {e}")
+
+
+class StreamCopier:
+    """
+    Copies a stream into a file through one reusable buffer, so no bytes
+    objects are allocated per chunk. Progress is reported at most every
+    progress_interval seconds instead of once per chunk.
+    """
+
+    def __init__(
+        self, buffer_size: Optional[int] = None, progress_interval: float = 0.1
+    ) -> None:
+        if buffer_size is None:
+            buffer_size = int(os.getenv("DOWNLOAD_BUFFER_KB", "256")) * 1024
+        self.buffer_size = buffer_size
+        self.progress_interval = progress_interval
+        self._buffer = bytearray(buffer_size)
+        self._view = memoryview(self._buffer)
+
+    def copy(
+        self,
+        source,
+        target: BinaryIO,
+        on_progress: Callable[[int], None],
+        abort: Optional[threading.Event] = None,
+        on_data: Optional[Callable[[memoryview], None]] = None,
+    ) -> bool:
+        """
+        Copy source into target until the end of source, calling on_progress
+        with the number of bytes copied so far and on_data with each chunk
+        written. Returns False if aborted.
+        """
+        copied = 0
+        last_report = time.monotonic()
+        while True:
+            if abort is not None and abort.is_set():
+                on_progress(copied)
+                return False
+            n = source.readinto(self._view)
+            if not n:
+                break
+            target.write(self._view[:n])
+            if on_data is not None:
+                on_data(self._view[:n])
+            copied += n
+
+            now = time.monotonic()
+            if now - last_report >= self.progress_interval:
+                last_report = now
+                on_progress(copied)
+
+        on_progress(copied)
+        return True
+
+
+class PipelinedCopier(StreamCopier):
+    """
+    Copies a stream into a file with the network reads and the disk writes
+    on separate threads, so a slow SD card write doesn't stop reading from
+    the socket. A reader thread fills a bounded ring of buffers and the
+    calling thread writes them out, the reader waits when every buffer is
+    full. The time each side spends waiting on the other is kept to tell
+    which one is the bottleneck.
+    """
+
+    def __init__(
+        self,
+        buffer_size: Optional[int] = None,
+        progress_interval: float = 0.1,
+        buffers: Optional[int] = None,
+    ) -> None:
+        super().__init__(buffer_size, progress_interval)
+        if buffers is None:
+            buffers = int(os.getenv("PIPELINE_BUFFERS", "16"))
+        self._views = [self._view] + [
+            memoryview(bytearray(self.buffer_size)) for _ in range(buffers - 1)
+        ]
+        # Seconds the reader waited for the disk and the writer for the network
+        self.disk_wait = 0.0
+        self.network_wait = 0.0
+
+    def _read(
+        self,
+        source,
+        free: queue.Queue,
+        filled: queue.Queue,
+        stop: threading.Event,
+    ) -> None:
+        try:
+            while not stop.is_set():
+                start = time.monotonic()
+                view = free.get()
+                self.disk_wait += time.monotonic() - start
+                if stop.is_set():
+                    break
+                n = source.readinto(view)
+                filled.put((view, n))
+                if not n:
+                    return
+        except Exception as e:
+            filled.put((e, 0))
+            return
+        filled.put((None, 0))
+
+    def copy(
+        self,
+        source,
+        target: BinaryIO,
+        on_progress: Callable[[int], None],
+        abort: Optional[threading.Event] = None,
+        on_data: Optional[Callable[[memoryview], None]] = None,
+    ) -> bool:
+        free: queue.Queue = queue.Queue()
+        filled: queue.Queue = queue.Queue()
+        for view in self._views:
+            free.put(view)
+        stop = threading.Event()
+        reader = threading.Thread(
+            target=self._read, args=(source, free, filled, stop), daemon=True
+        )
+        self.disk_wait = 0.0
+        self.network_wait = 0.0
+
+        copied = 0
+        completed = False
+        started = last_report = time.monotonic()
+        reader.start()
+        try:
+            while True:
+                if abort is not None and abort.is_set():
+                    break
+                start = time.monotonic()
+                view, n = filled.get()
+                self.network_wait += time.monotonic() - start
+                if isinstance(view, Exception):
+                    raise view
+                if not n:
+                    completed = True
+                    break
+                target.write(view[:n])
+                if on_data is not None:
+                    on_data(view[:n])
+                free.put(view)
+                copied += n
+
+                now = time.monotonic()
+                if now - last_report >= self.progress_interval:
+                    last_report = now
+                    on_progress(copied)
+        finally:
+            # Hand every buffer back so the reader can't block on the ring
+            stop.set()
+            for view in self._views:
+                free.put(view)
+            reader.join()
+
+        on_progress(copied)
+        elapsed = time.monotonic() - started
+        print(
+            f"Copied {copied} bytes in {elapsed:.1f}s, waited {self.network_wait:.1f}s "
+            f"on the network and {self.disk_wait:.1f}s on the disk"
+        )
+        return completed
+
+
+def create_copier() -> StreamCopier:
+    """Return the copier downloads use, PIPELINE_BUFFERS=1 disables the pipeline."""
+    if int(os.getenv("PIPELINE_BUFFERS", "16")) > 1:
+        return PipelinedCopier()
+    return StreamCopier()
+
+
+def split_segments(size: int, count: int) -> list[list[int]]:
+    """Split size bytes into count [first byte, last byte] ranges."""
+    segment_size = -(-size // count)
+    return [
+        [start, min(start + segment_size, size) - 1]
+        for start in range(0, size, segment_size)
+    ]
+
+
+class SegmentedDownload:
+    """
+    Fetches byte ranges of one file over parallel connections and writes
+    each at its offset with os.pwrite. A segment that fails is retried from
+    where it stopped. Segments are [next byte, last byte] lists, updated as
+    data is written so unfinished ones can be saved and resumed later.
+    """
+
+    retries = 3
+
+    def __init__(
+        self,
+        session,
+        url: str,
+        fd: int,
+        segments: list[list[int]],
+        validator: str,
+        on_progress: Callable[[int], None],
+        abort: threading.Event,
+        watchdog=None,
+        label: str = "",
+        buffer_size: Optional[int] = None,
+        progress_interval: float = 0.1,
+    ) -> None:
+        if buffer_size is None:
+            buffer_size = int(os.getenv("DOWNLOAD_BUFFER_KB", "256")) * 1024
+        self.session = session
+        self.watchdog = watchdog
+        self.label = label
+        self.url = url
+        self.fd = fd
+        self.segments = segments
+        self.validator = validator
+        self.on_progress = on_progress
+        self.abort = abort
+        self.buffer_size = buffer_size
+        self.progress_interval = progress_interval
+
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._error: Optional[Exception] = None
+        self._last_report = 0.0
+        self.written = 0
+
+    def _add_progress(self, n: int) -> None:
+        with self._lock:
+            self.written += n
+            now = time.monotonic()
+            if now - self._last_report < self.progress_interval:
+                return
+            self._last_report = now
+        self.on_progress(self.written)
+
+    def _pwrite(self, data: memoryview, position: int) -> None:
+        while data:
+            n = os.pwrite(self.fd, data, position)
+            data = data[n:]
+            position += n
+
+    def _fetch(self, segment: list[int], view: memoryview) -> None:
+        headers = {
+            "Range": f"bytes={segment[0]}-{segment[1]}",
+            "If-Range": self.validator,
+        }
+        with (
+            self.session.get(
+                self.url, headers=headers, priority=Priority.BULK
+            ) as response,
+            (
+                self.watchdog.watch(response, self.label)
+                if self.watchdog is not None
+                else nullcontext()
+            ),
+        ):
+            if response.status != 206:
+                raise HTTPError(
+                    self.url,
+                    response.status,
+                    "File changed on the server during the download",
+                    response.headers,
+                    None,
+                )
+            while segment[0] <= segment[1]:
+                if self.abort.is_set() or self._stop.is_set():
+                    return
+                n = response.readinto(view)
+                if not n:
+                    raise URLError("Connection closed before the end of the segment")
+                n = min(n, segment[1] - segment[0] + 1)
+                self._pwrite(view[:n], segment[0])
+                segment[0] += n
+                self._add_progress(n)
+
+    def _run_segment(self, segment: list[int]) -> None:
+        view = memoryview(bytearray(self.buffer_size))
+        attempt = 0
+        while segment[0] <= segment[1]:
+            if self.abort.is_set() or self._stop.is_set():
+                return
+            try:
+                self._fetch(segment, view)
+            except URLError as e:
+                # Client errors won't go away by retrying
+                if isinstance(e, HTTPError) and e.code < 500:
+                    self._fail(e)
+                    return
+                attempt += 1
+                if attempt > self.retries:
+                    self._fail(e)
+                    return
+                print(f"Retrying segment from byte {segment[0]}: {e}")
+                time.sleep(attempt)
+            except OSError as e:
+                self._fail(e)
+                return
+
+    def _fail(self, error: Exception) -> None:
+        with self._lock:
+            if self._error is None:
+                self._error = error
+        self._stop.set()
+
+    def run(self) -> bool:
+        """
+        Download the remaining segments. Returns False if aborted, raises
+        the first error of a segment that couldn't be completed.
+        """
+        threads = [
+            threading.Thread(target=self._run_segment, args=(segment,), daemon=True)
+            for segment in self.segments
+            if segment[0] <= segment[1]
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.on_progress(self.written)
+        if self._error is not None:
+            raise self._error
+        return all(segment[0] > segment[1] for segment in self.segments)
@@ -1,10 +1,12 @@
 import ctypes
+import math
 import os
-import shutil
 import time
-from typing import Optional
+from collections import Counter
+from typing import Any, Optional
 
 import sdl2
+from cache import ImageCache, TextCache
 from config import (
     color_btn_a,
     color_btn_b,
@@ -12,7 +14,7 @@ from config import (
 from filesystem import Filesystem
 from glyps import glyphs
 from models import Collection, Platform, Rom
-from PIL import Image, ImageDraw, ImageFont
+from PIL import Image, ImageColor, ImageDraw, ImageFont
 from status import Status
 
 FONT_FILE = {
@@ -26,6 +28,11 @@ color_menu_bg = "#141414"
 color_progress_bar = "#3d6b39"
 color_text = "#ffffff"
 
+# (left, top, right, bottom) in screen pixels, right/bottom exclusive
+Rect = tuple[int, int, int, int]
+# A recorded draw call: (signature, touched region, ref)
+DrawCall = tuple[tuple, Any, Any]
+
 
 class UserInterface:
     _instance: Optional["UserInterface"] = None
@@ -33,6 +40,7 @@ class UserInterface:
 
     fs = Filesystem()
     status = Status()
+    image_cache = ImageCache()
 
     screen_width = 640
     screen_height = 480
@@ -47,8 +55,20 @@ class UserInterface:
             return
         self.window = self._create_window()
         self.renderer = self._create_renderer()
-        self.draw_start()
+        self.texture = self._create_texture()
+        # Draw calls since the last clear, and the ones the texture currently shows
+        self._draw_calls: list[DrawCall] = []
+        self._presented_calls: list[DrawCall] = []
+        self._force_present = True
+        self.active_image = self.create_image()
+        self.active_draw = ImageDraw.Draw(self.active_image)
+        self.text_cache = TextCache(int(os.getenv("TEXT_CACHE_SIZE", "512")))
+        # Set when the current frame shows scrolling text
+        self.animating = False
         self.opt_stretch = True
+        # Destination rect is recomputed only when the window size changes
+        self._dst_rect: Optional[sdl2.SDL_Rect] = None
+        self._dst_rect_stretch = self.opt_stretch
         self._initialized = True
 
     def __new__(cls):
@@ -66,11 +86,79 @@ class UserInterface:
 
     def draw_start(self):
         """Initialize drawing for a new frame."""
-        # Render directly to the screen
-        sdl2.SDL_SetRenderDrawColor(self.renderer, 0, 0, 0, 255)
-        sdl2.SDL_RenderClear(self.renderer)
-        self.active_image = self.create_image()
-        self.active_draw = ImageDraw.Draw(self.active_image)
+        self.animating = False
+        self.draw_clear()
+
+    def _record(self, signature: tuple, region: Any, ref: Any = None) -> None:
+        """Record a draw call and the region it touched."""
+        self._draw_calls.append((signature, region, ref))
+
+    def _to_rect(self, box) -> Rect | None:
+        left = max(0, math.floor(min(box[0], box[2])))
+        top = max(0, math.floor(min(box[1], box[3])))
+        right = min(self.screen_width, math.ceil(max(box[0], box[2])) + 1)
+        bottom = min(self.screen_height, math.ceil(max(box[1], box[3])) + 1)
+        if left < right and top < bottom:
+            return (left, top, right, bottom)
+        return None
+
+    @staticmethod
+    def _merge_rects(rects: list[Rect]) -> list[Rect]:
+        """Coalesce overlapping rects so every pixel is uploaded once."""
+        merged: list[Rect] = []
+        for rect in rects:
+            while True:
+                for i, other in enumerate(merged):
+                    if (
+                        rect[0] <= other[2]
+                        and other[0] <= rect[2]
+                        and rect[1] <= other[3]
+                        and other[1] <= rect[3]
+                    ):
+                        rect = (
+                            min(rect[0], other[0]),
+                            min(rect[1], other[1]),
+                            max(rect[2], other[2]),
+                            max(rect[3], other[3]),
+                        )
+                        del merged[i]
+                        break
+                else:
+                    break
+            merged.append(rect)
+        return merged
+
+    def _get_dirty_rects(self) -> list[Rect]:
+        """Return the regions that differ from what the texture currently shows."""
+        if self._force_present:
+            return [(0, 0, self.screen_width, self.screen_height)]
+
+        current = [call[0] for call in self._draw_calls]
+        presented = [call[0] for call in self._presented_calls]
+        if current == presented:
+            return []
+
+        # Pixels are only affected by the draw calls covering them, so only the
+        # regions of calls that were added or removed since the last frame change
+        current_count = Counter(current)
+        presented_count = Counter(presented)
+        rects = []
+        for calls in (self._draw_calls, self._presented_calls):
+            for signature, region, _ref in calls:
+                if current_count[signature] == presented_count[signature]:
+                    continue
+                rect = self._to_rect(region)
+                if rect:
+                    rects.append(rect)
+
+        if not rects:
+            # Same calls in a different order, overlaps may have changed
+            return [(0, 0, self.screen_width, self.screen_height)]
+        return self._merge_rects(rects)
+
+    def force_redraw(self):
+        """Upload and present the next frame even if nothing was redrawn."""
+        self._force_present = True
 
     def _create_window(self):
         window = sdl2.SDL_CreateWindow(
@@ -100,27 +188,38 @@ class UserInterface:
         sdl2.SDL_SetHint(sdl2.SDL_HINT_RENDER_SCALE_QUALITY, b"0")
         return renderer
 
-    def render_to_screen(self):
-        # Convert PIL image to SDL2 texture at base resolution
-        rgba_data = self.active_image.tobytes()
-        surface = sdl2.SDL_CreateRGBSurfaceWithFormatFrom(
-            rgba_data,
+    def _create_texture(self):
+        # A single streaming texture at base resolution, updated in place every frame
+        texture = sdl2.SDL_CreateTexture(
+            self.renderer,
+            sdl2.SDL_PIXELFORMAT_RGBA32,
+            sdl2.SDL_TEXTUREACCESS_STREAMING,
             self.screen_width,
             self.screen_height,
-            32,
-            self.screen_width * 4,
-            sdl2.SDL_PIXELFORMAT_RGBA32,
         )
-        texture = sdl2.SDL_CreateTextureFromSurface(self.renderer, surface)
-        sdl2.SDL_FreeSurface(surface)
+
+        if not texture:
+            print(f"Failed to create texture: {sdl2.SDL_GetError()}")
+            raise RuntimeError("Failed to create texture")
+
+        return texture
+
+    def invalidate_window_size(self):
+        """Force the destination rect to be recomputed on the next frame."""
+        self._dst_rect = None
+        self.force_redraw()
+
+    def _get_dst_rect(self) -> sdl2.SDL_Rect:
+        if self._dst_rect is not None and self._dst_rect_stretch == self.opt_stretch:
+            return self._dst_rect
 
         # Get current window size
-        window_width = ctypes.c_int()
-        window_height = ctypes.c_int()
+        c_window_width = ctypes.c_int()
+        c_window_height = ctypes.c_int()
         sdl2.SDL_GetWindowSize(
-            self.window, ctypes.byref(window_width), ctypes.byref(window_height)
+            self.window, ctypes.byref(c_window_width), ctypes.byref(c_window_height)
         )
-        window_width, window_height = window_width.value, window_height.value
+        window_width, window_height = c_window_width.value, c_window_height.value
 
         # Let the user decide whether to stretch to fit or preserve aspect ratio
         if not self.opt_stretch:
@@ -135,11 +234,37 @@ class UserInterface:
         else:
             dst_rect = sdl2.SDL_Rect(0, 0, window_width, window_height)
 
-        sdl2.SDL_RenderCopy(self.renderer, texture, None, dst_rect)
+        self._dst_rect = dst_rect
+        self._dst_rect_stretch = self.opt_stretch
+        return dst_rect
+
+    def render_to_screen(self):
+        dirty_rects = self._get_dirty_rects()
+        self._presented_calls = list(self._draw_calls)
+        self._force_present = False
+
+        # Nothing changed since the last frame, keep it on screen
+        if not dirty_rects:
+            return
+
+        # Upload only the changed regions into the persistent texture
+        for rect in dirty_rects:
+            width = rect[2] - rect[0]
+            sdl2.SDL_UpdateTexture(
+                self.texture,
+                sdl2.SDL_Rect(rect[0], rect[1], width, rect[3] - rect[1]),
+                self.active_image.crop(rect).tobytes(),
+                width * 4,
+            )
+
+        sdl2.SDL_SetRenderDrawColor(self.renderer, 0, 0, 0, 255)
+        sdl2.SDL_RenderClear(self.renderer)
+        sdl2.SDL_RenderCopy(self.renderer, self.texture, None, self._get_dst_rect())
         sdl2.SDL_RenderPresent(self.renderer)
-        sdl2.SDL_DestroyTexture(texture)
 
     def cleanup(self):
+        print(f"Text cache: {self.text_cache.stats()}")
+        sdl2.SDL_DestroyTexture(self.texture)
         sdl2.SDL_DestroyRenderer(self.renderer)
         sdl2.SDL_DestroyWindow(self.window)
         sdl2.SDL_Quit()
@@ -152,6 +277,41 @@ class UserInterface:
         self.active_draw.rectangle(
             [0, 0, self.screen_width, self.screen_height], fill="black"
         )
+        self._draw_calls = []
+
+    def _render_text_sprite(
+        self,
+        text: str,
+        size: str,
+        color: str,
+        fraction: tuple[float, float],
+        **kwargs,
+    ) -> tuple[tuple[int, int], Image.Image]:
+        """
+        Rasterize text into a transparent RGBA sprite.
+        Returns the sprite and its offset from the integer draw position.
+        """
+        font = self.font_file[size]
+        bbox = self.active_draw.textbbox(fraction, text, font=font, **kwargs)
+        # Keep the text origin non-negative inside the sprite so subpixel
+        # positioning rounds exactly like drawing straight on the canvas
+        offset = (min(math.floor(bbox[0]), 0), min(math.floor(bbox[1]), 0))
+        sprite = Image.new(
+            "RGBA",
+            (
+                max(math.ceil(bbox[2]) - offset[0], 1),
+                max(math.ceil(bbox[3]) - offset[1], 1),
+            ),
+            ImageColor.getrgb(color)[:3] + (0,),
+        )
+        ImageDraw.Draw(sprite).text(
+            (fraction[0] - offset[0], fraction[1] - offset[1]),
+            text,
+            font=font,
+            fill=color,
+            **kwargs,
+        )
+        return offset, sprite
 
     def draw_text(
         self,
@@ -161,8 +321,23 @@ class UserInterface:
         color: str = color_text,
         **kwargs,
     ):
-        self.active_draw.text(
-            position, text, font=self.font_file[size], fill=color, **kwargs
+        if not text:
+            return
+
+        x, y = math.floor(position[0]), math.floor(position[1])
+        fraction = (position[0] - x, position[1] - y)
+        key = (text, size, color, fraction, tuple(kwargs.items()))
+        entry = self.text_cache.get(key)
+        if entry is None:
+            entry = self._render_text_sprite(text, size, color, fraction, **kwargs)
+            self.text_cache.put(key, entry)
+
+        offset, sprite = entry
+        dest = (x + offset[0], y + offset[1])
+        self.active_image.alpha_composite(sprite, dest)
+        self._record(
+            ("text", tuple(position), text, size, color, tuple(kwargs.items())),
+            (dest[0], dest[1], dest[0] + sprite.width - 1, dest[1] + sprite.height - 1),
         )
 
     def draw_rectangle(
@@ -173,6 +348,7 @@ class UserInterface:
         width: int = 1,
     ):
         self.active_draw.rectangle(position, fill=fill, outline=outline, width=width)
+        self._record(("rectangle", tuple(position), fill, outline, width), position)
 
     def draw_rectangle_r(
         self,
@@ -182,6 +358,25 @@ class UserInterface:
         outline: str | None = None,
     ):
         self.active_draw.rounded_rectangle(position, radius, fill=fill, outline=outline)
+        self._record(
+            ("rounded_rectangle", tuple(position), radius, fill, outline), position
+        )
+
+    def paste_image(self, image: Image.Image, position: tuple[int, int]):
+        self.active_image.paste(
+            image, position, mask=image if image.mode == "RGBA" else None
+        )
+        # Keep a reference to the image so its id can't be reused while recorded
+        self._record(
+            ("image", id(image), tuple(position)),
+            (
+                position[0],
+                position[1],
+                position[0] + image.width - 1,
+                position[1] + image.height - 1,
+            ),
+            image,
+        )
 
     def row_list(
         self,
@@ -198,13 +393,11 @@ class UserInterface:
     ):
         if fill is None:
             fill = color_btn_a if self.layout_name == "nintendo" else color_btn_b
-        try:
-            icon = Image.open(append_icon_path) if append_icon_path else None
-        except (FileNotFoundError, AttributeError):
-            icon = None
+        icon = self.image_cache.get(append_icon_path) if append_icon_path else None
 
         radius = 5
-        margin_left_text = 12 + (35 if icon else 0)
+        # Keep the icon slot while the icon is still being fetched
+        margin_left_text = 12 + (35 if append_icon_path else 0)
         margin_top_text = 8
         self.draw_rectangle_r(
             [position[0], position[1], position[0] + width, position[1] + height],
@@ -213,13 +406,16 @@ class UserInterface:
             outline=outline,
         )
 
+        margin_left_icon = 10
+        margin_top_icon = 5
+        icon_x, icon_y = position[0] + margin_left_icon, position[1] + margin_top_icon
         if icon:
-            margin_left_icon = 10
-            margin_top_icon = 5
-            self.active_image.paste(
-                icon,
-                (position[0] + margin_left_icon, position[1] + margin_top_icon),
-                mask=icon if icon.mode == "RGBA" else None,
+            self.paste_image(icon, (icon_x, icon_y))
+        elif append_icon_path:
+            self.draw_rectangle_r(
+                [icon_x, icon_y, icon_x + 30, icon_y + 30],
+                radius,
+                fill=color_menu_bg,
             )
 
         self.draw_text(
@@ -236,16 +432,14 @@ class UserInterface:
         fill: str | None = None,
         outline: str | None = color_text,
     ):
-        self.active_draw.ellipse(
-            [
-                position[0] - radius,
-                position[1] - radius,
-                position[0] + radius,
-                position[1] + radius,
-            ],
-            fill=fill,
-            outline=outline,
-        )
+        box = [
+            position[0] - radius,
+            position[1] - radius,
+            position[0] + radius,
+            position[1] + radius,
+        ]
+        self.active_draw.ellipse(box, fill=fill, outline=outline)
+        self._record(("ellipse", tuple(box), fill, outline), box)
 
     def button_circle(
         self,
@@ -355,31 +549,38 @@ class UserInterface:
 
     def draw_header(self, host: str, username: str):
         username = username if len(username) <= 22 else username[:19] + "..."
-        logo = Image.open(os.path.join(os.getcwd(), "resources/romm.png"))
+        logo = self.image_cache.get(os.path.join(os.getcwd(), "resources/romm.png"))
         pos_logo = [15, 15]
         pos_text = [55, 9]
-        self.active_image.paste(
-            logo, (pos_logo[0], pos_logo[1]), mask=logo if logo.mode == "RGBA" else None
-        )
+        if logo:
+            self.paste_image(logo, (pos_logo[0], pos_logo[1]))
 
         roms_path = self.fs.get_roms_storage_path()
-        total, used, _free = shutil.disk_usage(roms_path)
-
-        # Convert to GB
-        total_gb = total / (1024**3)
-        used_gb = used / (1024**3)
-
-        # Calculate percentage
-        used_percentage = (used / total) * 100
+        storage_text = f"{glyphs.microsd} {roms_path}"
+        usage = self.fs.get_storage_usage()
+        if usage:
+            # Convert to GB
+            total_gb = usage.total / (1024**3)
+            used_gb = usage.used / (1024**3)
+
+            # Calculate percentage
+            used_percentage = (usage.used / usage.total) * 100
+
+            storage_text += (
+                f" ({used_gb:.1f}/{total_gb:.1f} GB, {used_percentage:.1f}% used)"
+            )
 
         self.draw_text(
             (pos_text[0], pos_text[1]),
-            f"{glyphs.host} {host} | {glyphs.user} {username}\n"
-            f"{glyphs.microsd} {roms_path} ({used_gb:.1f}/{total_gb:.1f} GB, {used_percentage:.1f}% used)",
+            f"{glyphs.host} {host} | {glyphs.user} {username}\n{storage_text}",
         )
 
-        if self.status.profile_pic_path:
-            profile_pic = Image.open(self.status.profile_pic_path)
+        profile_pic = (
+            self.image_cache.get(self.status.profile_pic_path)
+            if self.status.profile_pic_path
+            else None
+        )
+        if profile_pic:
             margin_right_profile_pic = 45
             margin_top_profile_pic = 5
             pos_profile_pic = [
@@ -387,11 +588,7 @@ class UserInterface:
                 margin_top_profile_pic,
             ]
 
-            self.active_image.paste(
-                profile_pic,
-                (pos_profile_pic[0], pos_profile_pic[1]),
-                mask=profile_pic if profile_pic.mode == "RGBA" else None,
-            )
+            self.paste_image(profile_pic, (pos_profile_pic[0], pos_profile_pic[1]))
 
     def draw_platforms_list(
         self,
@@ -474,6 +671,7 @@ class UserInterface:
 
             if len(row_text) > max_len_text:
                 row_text = row_text + " "  # Add empty space for the rotation
+                self.animating = True
 
             # Calculate shift offset based on time
             shift_offset = (int(time.time() * 2)) % len(row_text)
@@ -502,7 +700,7 @@ class UserInterface:
         self,
         roms_selected_position: int,
         max_n_roms: int,
-        roms: list[Rom],
+        roms_page: list[Rom],
         header_text: str,
         header_color: str,
         multi_selected_roms: list[Rom],
@@ -532,9 +730,7 @@ class UserInterface:
             - padding
         )
 
-        start_idx = int(roms_selected_position / max_n_roms) * max_n_roms
-        end_idx = min(start_idx + max_n_roms, len(roms))
-        for i, r in enumerate(roms[start_idx:end_idx]):
+        for i, r in enumerate(roms_page):
             is_selected = i == (roms_selected_position % max_n_roms)
             is_in_device = self.fs.is_rom_in_device(r)
             sync_flag_text = f"{glyphs.cloud_sync}" if is_in_device else ""
@@ -549,6 +745,7 @@ class UserInterface:
             # Handle text scrolling
             if len(row_text) > max_len_text:
                 row_text = row_text + " "
+                self.animating = True
                 shift_offset = (int(time.time() * 2)) % len(row_text)
                 row_text = row_text[shift_offset:] + row_text[:shift_offset]
 
@@ -21,6 +21,8 @@ class Update:
         self.current_version = self.get_current_version()
         self.download_percent = 0.0
         self.total_size = 0
+        # Seconds without data before the update download is given up
+        self.stall_timeout = float(os.getenv("STALL_TIMEOUT", "30"))
 
     def get_current_version(self) -> str:
         """Read the version from __version__.py in the current directory."""
@@ -61,7 +63,9 @@ class Update:
         update_filename = os.path.basename(url)
         try:
             request = Request(url)
-            with urlopen(request) as response:  # trunk-ignore(bandit/B310)
+            with urlopen(  # trunk-ignore(bandit/B310)
+                request, timeout=self.stall_timeout
+            ) as response:
                 self.total_size = int(response.getheader("Content-Length", 0)) or 1
                 self.download_percent = 0.0
                 downloaded_bytes = 0
@@ -77,6 +81,7 @@ class Update:
                         self.download_percent = min(
                             100.0, (downloaded_bytes / self.total_size) * 100
                         )
+                        self.ui.draw_clear()
                         self.ui.draw_loader(self.download_percent)
                         self.ui.draw_log(
                             text_line_1="Downloading update...",
@@ -89,7 +94,8 @@ class Update:
                 self.status.updating.clear()
                 return True
 
-        except (HTTPError, URLError) as e:
+        except (HTTPError, URLError, OSError) as e:
+            # Reads that time out raise TimeoutError instead of URLError
             print(f"Update download failed: {e}")
             self.status.updating.clear()
             if os.path.exists(update_filename):
@@ -0,0 +1,100 @@
+import hashlib
+import os
+import zlib
+from typing import Optional
+
+from models import Rom
+
+# Hashes RomM keeps for each ROM file, fastest to compute first
+_HASH_FIELDS = {"crc": "crc_hash", "md5": "md5_hash", "sha1": "sha1_hash"}
+
+# RomM hashes the contents of these archives, not the archive itself
+_ARCHIVE_EXTENSIONS = {"zip", "7z", "tar", "gz", "bz2"}
+
+
+class IntegrityError(Exception):
+    """A downloaded ROM doesn't match the hash the server has for it."""
+
+
+class RomVerifier:
+    """
+    Checks a download against one of the hashes RomM has for the ROM. It's
+    updated with the chunks being written so the file isn't read back from
+    the SD card. VERIFY_HASH picks the hash (crc, md5, sha1 or none), another
+    one is used if the server doesn't have it. Multi-file ROMs and archives
+    aren't verified, their hashes don't cover the file being downloaded.
+    """
+
+    def __init__(self, rom: Rom, algorithm: Optional[str] = None) -> None:
+        if algorithm is None:
+            algorithm = os.getenv("VERIFY_HASH", "crc").lower()
+        self.rom = rom
+        self.algorithm: Optional[str] = None
+        self.expected = ""
+        self.bytes_hashed = 0
+        extension = (rom.fs_extension or "").lower().rsplit(".", 1)[-1]
+        if algorithm == "none" or rom.multi or extension in _ARCHIVE_EXTENSIONS:
+            return
+
+        candidates = [algorithm] + [name for name in _HASH_FIELDS if name != algorithm]
+        for name in candidates:
+            expected = getattr(rom, _HASH_FIELDS.get(name, ""), None)
+            if expected:
+                self.algorithm = name
+                self.expected = expected.lower()
+                break
+
+        self._crc = 0
+        self._hash = (
+            hashlib.new(self.algorithm) if self.algorithm in ("md5", "sha1") else None
+        )
+
+    @property
+    def enabled(self) -> bool:
+        return self.algorithm is not None
+
+    def update(self, data) -> None:
+        if self.algorithm is None:
+            return
+        if self._hash is not None:
+            self._hash.update(data)
+        else:
+            self._crc = zlib.crc32(data, self._crc)
+        self.bytes_hashed += len(data)
+
+    def update_from_file(
+        self, path: str, length: int, buffer_size: int = 1024**2
+    ) -> None:
+        """Hash the first length bytes of path, for data written earlier."""
+        if self.algorithm is None:
+            return
+        view = memoryview(bytearray(buffer_size))
+        with open(path, "rb") as f:
+            while length > 0:
+                n = f.readinto(view[: min(buffer_size, length)])
+                if not n:
+                    break
+                self.update(view[:n])
+                length -= n
+
+    def hexdigest(self) -> str:
+        if self._hash is not None:
+            return self._hash.hexdigest()
+        return f"{self._crc:08x}"
+
+    def verify(self) -> None:
+        """Raise IntegrityError if what was hashed doesn't match the server."""
+        if self.algorithm is None:
+            return
+        actual = self.hexdigest()
+        if self.algorithm == "crc":
+            # The server may not zero-pad CRCs
+            matches = actual == self.expected.zfill(8)
+        else:
+            matches = actual == self.expected
+        if not matches:
+            raise IntegrityError(
+                f"{self.rom.name} failed {self.algorithm} verification: "
+                f"expected {self.expected}, got {actual} "
+                f"over {self.bytes_hashed} bytes"
+            )
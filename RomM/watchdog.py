@@ -0,0 +1,106 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Iterator, Optional
+
+from session import Response
+from status import Status
+
+
+class _Transfer:
+    def __init__(self, response: Response, label: str) -> None:
+        self.response = response
+        self.label = label
+        self.last_bytes = 0
+        self.last_progress = time.monotonic()
+        # Moving average of the transfer rate in bytes per second
+        self.rate = 0.0
+        self.stalled = False
+
+
+class TransferWatchdog:
+    """
+    Polls the transfers in flight every interval seconds and aborts the
+    ones that received nothing for STALL_TIMEOUT seconds, such as a
+    half-open socket after a Wi-Fi roam. The read then fails with
+    TransferStalled so the caller can resume it. Time spent held back by the
+    bulk bandwidth limit doesn't count. Transfers blocked in a read
+    are also aborted once the downloads are. Keeps a moving average of each
+    transfer rate, and their sum in status.download_speed.
+    """
+
+    # Weight of the last interval in the moving average
+    smoothing = 0.3
+
+    def __init__(
+        self,
+        status: Status,
+        stall_timeout: Optional[float] = None,
+        interval: float = 1.0,
+    ) -> None:
+        if stall_timeout is None:
+            stall_timeout = float(os.getenv("STALL_TIMEOUT", "30"))
+        self.status = status
+        self.stall_timeout = stall_timeout
+        # Socket timeout for watched requests, in case the watchdog falls behind
+        self.read_timeout = stall_timeout * 2
+        self.interval = interval
+        self.stalls = 0
+
+        self._transfers: dict[int, _Transfer] = {}
+        self._lock = threading.Lock()
+        # Only polls while there are transfers to watch
+        self._thread: Optional[threading.Thread] = None
+
+    @contextmanager
+    def watch(self, response: Response, label: str) -> Iterator[_Transfer]:
+        transfer = _Transfer(response, label)
+        with self._lock:
+            self._transfers[id(transfer)] = transfer
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+        try:
+            yield transfer
+        finally:
+            with self._lock:
+                self._transfers.pop(id(transfer), None)
+
+    def _check(self, transfer: _Transfer, now: float) -> None:
+        if self.status.abort_download.is_set() and not transfer.response.aborted:
+            # Don't wait for the next read to notice the abort
+            transfer.response.abort()
+            return
+        received = transfer.response.bytes_read - transfer.last_bytes
+        transfer.last_bytes += received
+        transfer.rate += self.smoothing * (received / self.interval - transfer.rate)
+        if received or transfer.response.throttled:
+            # Waiting on the bandwidth limit isn't a stall
+            transfer.last_progress = now
+            return
+        if transfer.stalled or now - transfer.last_progress < self.stall_timeout:
+            return
+
+        transfer.stalled = True
+        self.stalls += 1
+        print(
+            f"{transfer.label} received nothing for {self.stall_timeout:.0f}s, "
+            "aborting the transfer"
+        )
+        self.status.show_notice(f"{transfer.label} stalled, retrying", 5.0)
+        transfer.response.abort()
+
+    def _run(self) -> None:
+        while True:
+            time.sleep(self.interval)
+            now = time.monotonic()
+            with self._lock:
+                transfers = list(self._transfers.values())
+                if not transfers:
+                    self._thread = None
+                    self.status.download_speed = 0.0
+                    return
+            for transfer in transfers:
+                self._check(transfer, now)
+            self.status.download_speed = sum(t.rate for t in transfers)